@@ -1,5 +1,6 @@
-import pandas as pd
-from queue import Queue, Empty
+import time
+from queue import Empty
+from s7comm import Snapshot, Broker, BatchPublisher, OfflineQueue
 from AWSIoTPythonSDK import MQTTLib
 
 key_path = r"C:\keys/"
@@ -11,38 +12,55 @@ ca_cert_path = key_path + "AmazonRootCA1.pem"
 
 topic = "PLC_Tanks"
 
-def publisher_thread(thread_timeout_s:float, plc_queue:Queue):
+# One payload per batch_samples samples or batch_delay_s seconds, undelivered payloads are spooled on disk
+batch_samples = 100
+batch_delay_s = 5.0
+payload_encoding = "json"
+payload_compression = "zlib"
+offline_queue_path = "spool"
+offline_queue_max_bytes = 16*1024*1024
+
+def publisher_thread(thread_timeout_s:float, plc_broker:Broker):
     '''
-    Collect data until queue timeout runs out
+    Collect data until queue timeout runs out, Broker.receive() records the age of every sample
     '''
     s7publisher = MQTTLib.AWSIoTMQTTClient("s7PLC_Publisher")
     s7publisher.configureEndpoint(endpoint, 8883)
     s7publisher.configureCredentials(ca_cert_path, key_private_path, cert_path)
     
-    s7publisher.configureOfflinePublishQueueing(-1)  
+    # The bounded disk queue of the BatchPublisher replaces the unbounded queue of the SDK
+    s7publisher.configureOfflinePublishQueueing(0)  
     s7publisher.configureDrainingFrequency(2)  
     s7publisher.configureConnectDisconnectTimeout(10)  
     s7publisher.configureMQTTOperationTimeout(10)  
     
     off_condition = not s7publisher.connect()
     
+    publisher = BatchPublisher(
+        send = lambda payload: s7publisher.publish(topic=topic, payload=payload, QoS=1),
+        max_samples = batch_samples,
+        max_delay_s = batch_delay_s,
+        encoding = payload_encoding,
+        compression = payload_compression,
+        offline_queue = OfflineQueue(offline_queue_path, offline_queue_max_bytes),
+        source = topic
+    )
+    last_message = time.monotonic()
 
     while not off_condition:
         try:
-            plc_data = plc_queue.get(timeout=thread_timeout_s)
-            if type(plc_data) is pd.DataFrame:
-                publish_message = plc_data.to_json()
-                s7publisher.publish(
-                    topic = topic,
-                    payload = publish_message,
-                    QoS=0
-                )
+            plc_data = plc_broker.receive(timeout=publisher.wait_s(thread_timeout_s))
+            last_message = time.monotonic()
+            if type(plc_data) is Snapshot:
+                publisher.add(plc_data)
             elif plc_data == 'kill consumer':
                 off_condition = True
         except Empty: 
-            off_condition = True
+            off_condition = time.monotonic() - last_message >= thread_timeout_s
         except AttributeError:
             print(f'PLC data might have wrong structure')
+        publisher.poll()
     else:
+        publisher.flush()
         s7publisher.disconnect()
         print('Publisher thread ended')
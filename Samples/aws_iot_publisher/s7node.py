@@ -14,7 +14,7 @@ s7Broker = s7comm.Broker('ExchangeData.xlsx')
 print(s7Broker)
 s7Broker.auto_config()
 s7Broker.change_connection_options(PLC_IP, DB_NUMBER, INTERVAL_S)
-plc_consumer_thread = Thread(target=publisher_thread, args=(CONSUMER_TIMEOUT_S, s7Broker.broker_queue))
+plc_consumer_thread = Thread(target=publisher_thread, args=(CONSUMER_TIMEOUT_S, s7Broker))
 
 s7Broker.start()
 plc_consumer_thread.start()
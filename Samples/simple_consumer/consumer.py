@@ -1,17 +1,17 @@
-import pandas as pd
-from queue import Queue, Empty
+from queue import Empty
+from s7comm import Snapshot, Broker
 
 
-def consumer_thread(thread_timeout_s:float, plc_queue:Queue):
+def consumer_thread(thread_timeout_s:float, plc_broker:Broker):
     
     '''
-    Collect data until queue timeout runs out
+    Collect data until queue timeout runs out, Broker.receive() records the age of every sample
     '''
     off_condition = False
     while not off_condition:
         try:
-            plc_data = plc_queue.get(timeout=thread_timeout_s)
-            if type(plc_data) is pd.DataFrame:
+            plc_data = plc_broker.receive(timeout=thread_timeout_s)
+            if type(plc_data) is Snapshot:
                 message = '''
                         Tank1           
 Level                   {:3d}           
@@ -19,17 +19,17 @@ Discharge Flow          {:3d}
 Set Point               {:3d}           
 Control Variable        {:3.2f}            
 '''.format(
-    plc_data.loc['iT1_LVL'].Value, 
-    plc_data.loc['iT1_DIS_FL'].Value, 
-    plc_data.loc['iT1_SP'].Value, 
-    plc_data.loc['rT1_MV'].Value, 
+    plc_data['iT1_LVL'], 
+    plc_data['iT1_DIS_FL'], 
+    plc_data['iT1_SP'], 
+    plc_data['rT1_MV'], 
     )
                 print(message)
             elif plc_data == 'kill consumer':
                 off_condition = True
         except Empty: 
             off_condition = True
-        except AttributeError:
+        except (AttributeError, KeyError):
             print(f'PLC data might have wrong structure')
     else:
         print('Consumer thread ended')
\ No newline at end of file
@@ -0,0 +1,390 @@
+'''Benchmarks guarding the s7comm hot paths.
+
+Usage
+-----
+python s7bench.py import [--budget-ms 500] [--repeat 5]
+python s7bench.py run [--tags 10 100 1000 10000] [--frames 2000] [--seed 0] [--output results.json]
+python s7bench.py compare baseline.json results.json [--tolerance 0.1]
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# Modules the headless polling and decoding path must not load
+heavy_modules = ['pandas', 'openpyxl']
+
+import_probe = '''
+import json, sys, time
+start = time.perf_counter()
+import s7comm
+elapsed_ms = (time.perf_counter() - start)*1000
+print(json.dumps({'import_ms': elapsed_ms, 'loaded': [m for m in %r if m in sys.modules]}))
+''' % (heavy_modules,)
+
+# Row pattern of the ExchangeData.xlsx tanks: 3 Int, 3 Real and 5 Bool alarms
+synthetic_pattern = ['Int']*3 + ['Real']*3 + ['Bool']*5
+
+# Suffixes of the result keys telling if a higher value is better
+higher_is_better = ('_fps', '_per_s')
+lower_is_better = ('_s', '_ns', '_bytes')
+
+def bench_import(repeat:int=5) -> dict:
+    '''Measure the cold import time of s7comm in fresh interpreters.
+
+    Parameters
+    ----------
+    repeat : int
+        Number of interpreters started, the fastest one is reported.
+
+    Returns
+    -------
+    dict
+        import_ms and the heavy modules loaded by the import.
+    '''
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+                                [sys.executable, '-c', import_probe],
+                                cwd=directory,
+                                capture_output=True,
+                                text=True,
+                                check=True
+                                ).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+    return {
+        'import_ms'     : min(run['import_ms'] for run in runs),
+        'heavy_modules' : sorted(set(module for run in runs for module in run['loaded'])),
+    }
+
+def check_import(budget_ms:float, repeat:int) -> bool:
+    '''
+    Print the import benchmark, return False if a heavy module was loaded or the budget was exceeded
+    '''
+    result = bench_import(repeat)
+    print(json.dumps(result))
+    if result['heavy_modules']:
+        print(f's7bench> Importing s7comm loads: {", ".join(result["heavy_modules"])}')
+        return False
+    if result['import_ms'] > budget_ms:
+        print(f's7bench> Import took {result["import_ms"]:.1f} ms, budget is {budget_ms} ms')
+        return False
+    return True
+
+def synthetic_layout(tag_count:int) -> dict:
+    '''Build an ExchangeData.xlsx-style layout of any size.
+
+    Parameters
+    ----------
+    tag_count : int
+        Number of tags.
+
+    Returns
+    -------
+    dict
+        names, types, offsets and comments lists, see s7comm.load_layout().
+    '''
+
+    import s7comm
+    layout = {'names': [], 'types': [], 'offsets': [], 'comments': []}
+    byte_index, bit_index = 0, 0
+    for tag in range(tag_count):
+        data_type = synthetic_pattern[tag % len(synthetic_pattern)]
+        if data_type == 'Bool':
+            offset = byte_index + bit_index/10
+            bit_index += 1
+            if bit_index == 8:
+                byte_index, bit_index = byte_index + 1, 0
+        else:
+            # Bytes after the Bools are aligned to a word
+            if bit_index:
+                byte_index, bit_index = byte_index + 1, 0
+            byte_index += byte_index % 2
+            offset = float(byte_index)
+            byte_index += s7comm.s7_type(data_type).size
+        layout['names'].append(f'{data_type[0].lower()}Tag{tag}')
+        layout['types'].append(data_type)
+        layout['offsets'].append(offset)
+        layout['comments'].append('')
+    return layout
+
+def synthetic_broker(layout:dict, logs_path:str=None):
+    '''
+    Configure a BrokerSim from a layout instead of a config file
+    '''
+    import s7comm
+    broker = s7comm.BrokerSim(logs_path, None)
+    broker.layout = layout
+    broker.df_values_created = True
+    broker.analyze_layout()
+    broker.define_full_byte_range()
+    broker.compile_decoder()
+    return broker
+
+def synthetic_frames(layout:dict, frame_count:int, seed:int=0):
+    '''Generate s7frames of a layout, Int and Real tags follow slow sine waves.
+
+    Returns
+    -------
+    np.ndarray
+        2-D uint8 array, one row per s7frame.
+    '''
+
+    import numpy as np
+    import s7comm
+    analysis = s7comm.analyze_layout(layout)
+    generator = np.random.default_rng(seed)
+    frames = generator.integers(0, 256, size=(frame_count, analysis['span']), dtype=np.uint8)
+    time_axis = np.arange(frame_count)/100
+    for slot, (data_type, offset) in enumerate(zip(layout['types'], layout['offsets'])):
+        byte_index = s7comm.split_offset(offset)[0] - analysis['offset_start']
+        if data_type in ('Int', 'Real'):
+            wave = 100*np.sin(time_axis + slot)
+            dtype = '>i2' if data_type == 'Int' else '>f4'
+            size = s7comm.s7_type(data_type).size
+            frames[:, byte_index:byte_index + size] = wave.astype(dtype).view(np.uint8).reshape(frame_count, size)
+    return frames
+
+def percentiles(samples:list) -> tuple:
+    '''
+    p50 and p99 of a list of numbers
+    '''
+    ordered = sorted(samples)
+    return ordered[len(ordered)//2], ordered[min(len(ordered) - 1, int(len(ordered)*0.99))]
+
+def bench_decode(layout:dict, frames) -> dict:
+    '''Measure decoding of a layout.
+
+    Returns
+    -------
+    dict
+        decode_fps of FrameDecoder.decode(), batch_decode_fps of decode_batch() and
+        cycle_fps of Broker.decode_frame(), which also builds the Snapshot.
+    '''
+
+    import s7comm
+    broker = synthetic_broker(layout)
+    decoder = broker.decoder
+    rows = [frame.tobytes() for frame in frames]
+    stamp = s7comm.ReadStamp.now()
+
+    start = time.perf_counter()
+    for row in rows:
+        decoder.decode(row)
+    decode_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decoder.decode_batch(frames)
+    batch_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for row in rows:
+        broker.decode_frame(row, stamp)
+    cycle_s = time.perf_counter() - start
+    return {
+        'decode_fps'       : len(rows)/decode_s,
+        'batch_decode_fps' : len(rows)/batch_s,
+        'cycle_fps'        : len(rows)/cycle_s,
+    }
+
+def bench_allocations(layout:dict, frames, cycles:int=200) -> dict:
+    '''Trace the memory allocated by decode cycles with tracemalloc.
+
+    Returns
+    -------
+    dict
+        cycle_peak_bytes, the peak of a single Broker.decode_frame() cycle, and
+        cycle_retained_bytes, memory still held per cycle (a leak if it keeps growing).
+    '''
+
+    import s7comm
+    broker = synthetic_broker(layout)
+    rows = [frames[cycle % len(frames)].tobytes() for cycle in range(cycles)]
+    stamp = s7comm.ReadStamp.now()
+    broker.decode_frame(rows[0], stamp)
+    tracemalloc.start()
+    try:
+        peaks = []
+        start_current, _ = tracemalloc.get_traced_memory()
+        for row in rows:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            broker.decode_frame(row, stamp)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+        stop_current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'cycle_peak_bytes'     : sum(peaks)/len(peaks),
+        'cycle_retained_bytes' : (stop_current - start_current)/cycles,
+    }
+
+def bench_handoff(layout:dict, messages:int=2000) -> dict:
+    '''Measure the hand-off of messages from Broker.publish() to Broker.receive() in another thread.
+
+    Returns
+    -------
+    dict
+        handoff_p50_s and handoff_p99_s latencies, handoff_per_s messages per second.
+    '''
+
+    broker = synthetic_broker(layout)
+    latencies = []
+
+    def consume():
+        for _ in range(messages):
+            sent_ns = broker.receive()
+            latencies.append(time.perf_counter_ns() - sent_ns)
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    start = time.perf_counter()
+    for _ in range(messages):
+        # Queue of size 1, wait for the consumer so no message is dropped
+        while broker.broker_queue.full():
+            time.sleep(0)
+        broker.publish(time.perf_counter_ns())
+    consumer.join()
+    elapsed_s = time.perf_counter() - start
+    p50, p99 = percentiles(latencies)
+    return {
+        'handoff_p50_s' : p50/1e9,
+        'handoff_p99_s' : p99/1e9,
+        'handoff_per_s' : messages/elapsed_s,
+    }
+
+def bench_replay(layout:dict, frames) -> dict:
+    '''Measure the unthrottled BrokerSim replay of a binary frame log.
+
+    Returns
+    -------
+    dict
+        replay_fps of the replayed frames and log_write_fps of FrameLogWriter.
+    '''
+
+    import s7comm
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.s7log')
+        start = time.perf_counter()
+        with s7comm.FrameLogWriter(path) as frame_log:
+            for frame in frames:
+                frame_log.write(frame.tobytes(), 1)
+        write_s = time.perf_counter() - start
+
+        broker = synthetic_broker(layout, path)
+        broker.change_replay_options(speed=0)
+        start = time.perf_counter()
+        broker.run()
+        replay_s = time.perf_counter() - start
+    return {
+        'replay_fps'    : len(frames)/replay_s,
+        'log_write_fps' : len(frames)/write_s,
+    }
+
+def run_benchmarks(tag_counts:list, frame_count:int, seed:int=0) -> dict:
+    '''Run the whole suite for every layout size.
+
+    Returns
+    -------
+    dict
+        meta (interpreter and library versions) and results, a flat
+        'tags_<n>.<metric>' -> value dictionary for regression comparison.
+    '''
+
+    import numpy as np
+    results = {}
+    for tag_count in tag_counts:
+        layout = synthetic_layout(tag_count)
+        frames = synthetic_frames(layout, frame_count, seed)
+        print(f's7bench> {tag_count} tags, {frames.shape[1]} bytes per frame')
+        measured = {}
+        measured.update(bench_decode(layout, frames))
+        measured.update(bench_allocations(layout, frames))
+        measured.update(bench_handoff(layout))
+        measured.update(bench_replay(layout, frames))
+        for name, value in measured.items():
+            results[f'tags_{tag_count}.{name}'] = value
+    return {
+        'meta'    : {
+            'python'      : platform.python_version(),
+            'numpy'       : np.__version__,
+            'machine'     : platform.machine(),
+            'frames'      : frame_count,
+            'seed'        : seed,
+            'created_ns'  : time.time_ns(),
+        },
+        'results' : results,
+    }
+
+def compare_results(baseline:dict, current:dict, tolerance:float=0.1) -> list:
+    '''Find the results which got worse by more than the tolerance.
+
+    Parameters
+    ----------
+    baseline : dict
+        Results of run_benchmarks() to compare against.
+    current : dict
+        Results of run_benchmarks().
+    tolerance : float
+        Allowed relative change.
+
+    Returns
+    -------
+    list of tuple
+        (key, baseline value, current value, relative change) of the regressions.
+    '''
+
+    regressions = []
+    for key, current_value in sorted(current['results'].items()):
+        baseline_value = baseline['results'].get(key)
+        if baseline_value is None or baseline_value == 0:
+            continue
+        change = (current_value - baseline_value)/abs(baseline_value)
+        metric = key.split('.')[-1]
+        if metric.endswith(higher_is_better) and change < -tolerance:
+            regressions.append((key, baseline_value, current_value, change))
+        elif not metric.endswith(higher_is_better) and metric.endswith(lower_is_better) and change > tolerance:
+            regressions.append((key, baseline_value, current_value, change))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='s7comm benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+    parser_import = commands.add_parser('import', help='guard the cold import of s7comm')
+    parser_import.add_argument('--budget-ms', type=float, default=500.0)
+    parser_import.add_argument('--repeat', type=int, default=5)
+    parser_run = commands.add_parser('run', help='decode, allocation, hand-off and replay benchmarks')
+    parser_run.add_argument('--tags', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser_run.add_argument('--frames', type=int, default=2000)
+    parser_run.add_argument('--seed', type=int, default=0)
+    parser_run.add_argument('--output', default=None, help='JSON file receiving the results')
+    parser_compare = commands.add_parser('compare', help='report regressions between two result files')
+    parser_compare.add_argument('baseline')
+    parser_compare.add_argument('current')
+    parser_compare.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        sys.exit(0 if check_import(args.budget_ms, args.repeat) else 1)
+    elif args.command == 'run':
+        results = run_benchmarks(args.tags, args.frames, args.seed)
+        print(json.dumps(results, indent=2))
+        if not args.output is None:
+            with open(args.output, 'w') as results_file:
+                json.dump(results, results_file, indent=2)
+    elif args.command == 'compare':
+        with open(args.baseline) as baseline_file, open(args.current) as current_file:
+            regressions = compare_results(json.load(baseline_file), json.load(current_file), args.tolerance)
+        for key, baseline_value, current_value, change in regressions:
+            print(f's7bench> {key}: {baseline_value:.6g} -> {current_value:.6g} ({change:+.1%})')
+        sys.exit(1 if regressions else 0)
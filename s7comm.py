@@ -1,10 +1,22 @@
-import pandas as pd
 import numpy as np
 import snap7
 import time
 import socket
-from queue import Queue, Full
-from threading import Event, Thread
+import os
+import struct
+import itertools
+import math
+import random
+import re
+import json
+import hashlib
+import ctypes
+import bisect
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from queue import Queue, Empty, Full
+from threading import Event, Lock, RLock, Thread
 
 s7_bytes_to_read = {
     'Int'  : 2,
@@ -18,13 +30,86 @@ s7_bits_to_read = {
     'Bool' : 1,    
 }
 
-# ONLY BOOL TESTED
-s7_additional_offset = {
-    'Int'  : 2,
-    'Real' : 4,
-    'Bool' : 0,     
+# Datablock layout columns of the .xlsx config file and version of their cache
+layout_columns = ['Name', 'Data type', 'Offset', 'Comment']
+layout_cache_version = 1
+
+# Binary frame log layout
+# File header: magic, version, frame size, wall-clock ns and monotonic ns at creation
+# Record v1: monotonic timestamp ns, datablock number, raw s7frame
+# Record v2: wall-clock and monotonic ns before and after the read, datablock number, raw s7frame
+frame_log_magic = b'S7FL'
+frame_log_version = 2
+frame_log_header = struct.Struct('<4sHHqq')
+frame_log_record_headers = {
+    1 : struct.Struct('<qH'),
+    2 : struct.Struct('<qqqqH'),
+}
+# Field of the request monotonic ns in the record headers
+frame_log_monotonic_fields = {1: 0, 2: 2}
+# Largest shift of the wall-clock minus monotonic difference tolerated when appending,
+# beyond it the monotonic clock was restarted (reboot) or the wall-clock stepped
+frame_log_clock_tolerance_ns = 1_000_000_000
+
+# python-snap7 2.0 renamed the snap7.types module to snap7.type
+snap7_types = snap7.types if hasattr(snap7, 'types') else snap7.type
+# Errors of a client request, python-snap7 2.0 raises its own S7Error instead of RuntimeError
+s7_errors = (RuntimeError, snap7.error.S7Error) if hasattr(snap7.error, 'S7Error') else (RuntimeError,)
+
+# Memory areas of the read planner
+s7_areas = {
+    'DB' : snap7_types.Areas.DB,
+    'M'  : snap7_types.Areas.MK,
+    'I'  : snap7_types.Areas.PE,
+    'Q'  : snap7_types.Areas.PA,
 }
 
+# Word length of the byte reads, only an enum member since python-snap7 2.0
+s7_byte_word_length = snap7_types.S7WLByte if hasattr(snap7_types, 'S7WLByte') else int(snap7_types.WordLen.Byte)
+
+# S7 read request/response overhead in bytes
+s7_read_request_header = 19
+s7_read_request_item = 12
+s7_read_response_header = 14
+s7_read_response_item = 4
+s7_max_read_items = 20
+
+# Contiguous bytes of a memory area, dbnumber is 0 outside of the DB area
+ReadRange = namedtuple('ReadRange', ['area', 'dbnumber', 'start', 'size'])
+
+# Samples read from a SampleRing, chunks hold views of the ring columns
+RingRead = namedtuple('RingRead', ['start_seq', 'stop_seq', 'dropped', 'chunks'])
+
+class ReadStamp(namedtuple('ReadStamp', ['request_ns', 'response_ns', 'request_monotonic_ns', 'response_monotonic_ns'])):
+    '''ReadStamp class\n
+    Wall-clock (UTC) and monotonic ns taken right before the first and right
+    after the last read request of a sample.
+    '''
+    
+    __slots__ = ()
+    
+    @classmethod
+    def now(cls) -> 'ReadStamp':
+        '''
+        Stamp of a sample which was not read from a PLC, both ends are now
+        '''
+        wall_clock_ns, monotonic_ns = time.time_ns(), time.monotonic_ns()
+        return cls(wall_clock_ns, wall_clock_ns, monotonic_ns, monotonic_ns)
+    
+    @property
+    def timestamp_ns(self) -> int:
+        '''
+        Wall-clock time of the sample, the middle of the read
+        '''
+        return (self.request_ns + self.response_ns)//2
+    
+    @property
+    def read_ns(self) -> int:
+        '''
+        Duration of the read on the monotonic clock
+        '''
+        return self.response_monotonic_ns - self.request_monotonic_ns
+
 def clear_logs(path:str) -> None:
     '''Clear all the data stored in the path.
     
@@ -97,85 +182,3154 @@ def get_bit(s7frame:bytearray, index_byte:int, index_bit:int):
         Returned if the index_bit is invalid.
     '''
     
-    byte = np.array(s7frame[index_byte], dtype='uint8')
-    bits = np.unpackbits(byte)
-    bit = bits[index_bit] if 0<=index_bit<=7 else None
-    return bit
+    byte = np.array(s7frame[index_byte], dtype='uint8')
+    bits = np.unpackbits(byte, bitorder='little')
+    bit = bits[index_bit] if 0<=index_bit<=7 else None
+    return bit
+
+def frombuffer(buffer:bytearray, type:str):
+    '''Transform bytes to a value depending on the type.\n
+    S7 family defines big-endian coding.
+    
+    Parameters
+    ----------
+    buffer : bytearray
+        Bytes to be transformed into a value.
+    type : str
+        Type of the value.
+    
+    Returns
+    -------
+    float
+        If the type was defined as a Real. Real refers to s7 family.
+    int
+        If the type was defines as an Int.
+    None
+        If the type differs from the ones above.
+    '''
+    
+    value = None
+    if type=='Int':
+        value = np.frombuffer(buffer, dtype='>i2')
+    elif type=='Real':
+        value = np.frombuffer(buffer, dtype='>f')
+    return value[0] if not value is None else None
+
+def extract(s7frame:bytearray, offset:float, type:str):
+    '''Extract value from s7frame
+    
+    Parameters
+    ----------
+    s7frame : bytearray
+        S7 protocol frame.
+    offset : float
+        Offset is an indicator for a postion of a value to be extracted.
+    type : str
+        Type of the value.
+    
+    Returns
+    -------
+    float
+        If the type was float
+    int
+        If the type was an int
+    np.uint8
+        If the type was bool
+    None
+        If the type was none of the above
+    '''
+    
+    bytes_to_read = 0
+    bits_to_read = 0
+    bytes = None
+    bit = None
+    value = None
+
+    # Separate the number and its floating point
+    byte_start_index = int(offset)
+    bit_start_index = np.ceil((offset*10-byte_start_index*10)).astype('uint8')
+
+    # Change data amount to read according to the s7 data types    
+    bytes_to_read = s7_bytes_to_read[type]
+    bits_to_read = s7_bits_to_read[type]
+    
+    # Get binary data and transform it to the actual value
+    if bytes_to_read>0:
+        bytes = get_bytes(s7frame, byte_start_index, byte_start_index + bytes_to_read)
+        value = frombuffer(bytes, type)
+    elif bits_to_read==1:
+        bit = get_bit(s7frame, byte_start_index, bit_start_index)
+        value = bit      
+    return value
+
+def split_offset(offset:float) -> tuple:
+    '''Split a TIA Portal offset into a byte index and a bit index.
+    
+    Parameters
+    ----------
+    offset : float
+        Offset in the byte.bit notation, e.g. 18.3
+    
+    Returns
+    -------
+    tuple
+        (byte_index, bit_index)
+    '''
+    
+    byte_index = int(offset)
+    bit_index = int(round((offset - byte_index)*10))
+    return byte_index, bit_index
+
+def decode_number(raw:np.ndarray, s7type) -> np.ndarray:
+    '''
+    Decode big-endian numbers, the last axis of raw holds the bytes of a value
+    '''
+    return raw.view(s7type.raw_dtype)[..., 0].astype(s7type.dtype)
+
+def decode_bool(raw:np.ndarray, s7type, masks:np.ndarray) -> np.ndarray:
+    '''
+    Decode bits, raw holds a single byte per value
+    '''
+    return (raw & masks) != 0
+
+def decode_duration(raw:np.ndarray, s7type) -> np.ndarray:
+    '''
+    Decode Time, LTime and Time_Of_Day counters into timedelta64
+    '''
+    counts = raw.view(s7type.raw_dtype)[..., 0].astype(np.int64)
+    return counts.astype(f'm8[{s7type.unit}]').astype(s7type.dtype)
+
+def decode_date(raw:np.ndarray, s7type) -> np.ndarray:
+    '''
+    Decode Date, days since 1990-01-01
+    '''
+    days = raw.view(s7type.raw_dtype)[..., 0].astype('timedelta64[D]')
+    return np.datetime64('1990-01-01', 'D') + days
+
+def decode_dtl(raw:np.ndarray, s7type) -> np.ndarray:
+    '''
+    Decode DTL: year, month, day, weekday, hour, minute, second, nanosecond.
+    Zeroed DTLs decode to NaT.
+    '''
+    year = raw[..., 0:2].copy().view('>u2')[..., 0].astype(np.int64)
+    month = raw[..., 2].astype(np.int64)
+    day = raw[..., 3].astype(np.int64)
+    months = ((year - 1970)*12 + month - 1).astype('datetime64[M]')
+    dates = months.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+    nanoseconds = raw[..., 8:12].copy().view('>u4')[..., 0].astype(np.int64)
+    time_of_day = raw[..., 5].astype(np.int64)*3600 + raw[..., 6].astype(np.int64)*60 + raw[..., 7].astype(np.int64)
+    timestamps = dates.astype(s7type.dtype) + (time_of_day*1000000 + nanoseconds//1000).astype('timedelta64[us]')
+    timestamps[(month == 0) | (day == 0)] = np.datetime64('NaT')
+    return timestamps
+
+def decode_char(raw:np.ndarray, s7type) -> np.ndarray:
+    '''
+    Decode Char (Latin-1) and WChar (UCS-2) into single character strings
+    '''
+    codes = raw.view(s7type.raw_dtype).astype(np.uint32)
+    return codes.view('U1')[..., 0].astype(object)
+
+def decode_string(raw:np.ndarray, s7type) -> np.ndarray:
+    '''
+    Decode String[n] (Latin-1) and WString[n] (UCS-2): max length, actual length, characters
+    '''
+    header = raw[..., :s7type.header_size].copy().view(s7type.raw_dtype)
+    lengths = np.minimum(header[..., 1].astype(np.intp), s7type.max_length)
+    codes = raw[..., s7type.header_size:].copy().view(s7type.raw_dtype).astype(np.uint32)
+    # Characters past the actual length are cleared, trailing NULs are dropped by the U dtype
+    codes[np.arange(s7type.max_length) >= lengths[..., None]] = 0
+    return codes.view(f'U{s7type.max_length}')[..., 0].astype(object)
+
+
+class S7Type:
+    '''S7Type class\n
+    Entry of the s7 type registry: width in bytes and a vectorized decoding rule.
+    
+    Parameters
+    ----------
+    name : str
+        S7 type name, e.g. DInt or String[20].
+    size : int
+        Width in bytes, a Bool reads a single byte.
+    kind : str
+        'bool', 'number' or 'other', numbers support deadbands.
+    dtype : str
+        NumPy dtype of the decoded values.
+    rule : function
+        Decoding rule, rule(raw, s7type) with the bytes of a value on the last axis of raw.
+    raw_dtype : str or None
+        Big-endian dtype of the raw value, or of the header and characters of a string.
+    **params
+        Extra attributes used by the rule, e.g. unit or max_length.
+    '''
+    
+    def __init__(self, name:str, size:int, kind:str, dtype:str, rule, raw_dtype:str=None, **params):
+        self.name = name
+        self.size = size
+        self.kind = kind
+        self.dtype = np.dtype(dtype)
+        self.rule = rule
+        self.raw_dtype = None if raw_dtype is None else np.dtype(raw_dtype)
+        for key, value in params.items():
+            setattr(self, key, value)
+            
+    def __repr__(self):
+        return f'S7Type({self.name}, {self.size} bytes)'
+            
+    def decode(self, raw:np.ndarray, *args) -> np.ndarray:
+        return self.rule(raw, self, *args)
+
+
+# Registry of the s7 types with a fixed width
+s7_types = {
+    'Bool'          : S7Type('Bool', 1, 'bool', '?', decode_bool),
+    'Byte'          : S7Type('Byte', 1, 'number', 'u1', decode_number, '>u1'),
+    'USInt'         : S7Type('USInt', 1, 'number', 'u1', decode_number, '>u1'),
+    'SInt'          : S7Type('SInt', 1, 'number', 'i1', decode_number, '>i1'),
+    'Word'          : S7Type('Word', 2, 'number', 'u2', decode_number, '>u2'),
+    'UInt'          : S7Type('UInt', 2, 'number', 'u2', decode_number, '>u2'),
+    'Int'           : S7Type('Int', 2, 'number', 'i2', decode_number, '>i2'),
+    'DWord'         : S7Type('DWord', 4, 'number', 'u4', decode_number, '>u4'),
+    'UDInt'         : S7Type('UDInt', 4, 'number', 'u4', decode_number, '>u4'),
+    'DInt'          : S7Type('DInt', 4, 'number', 'i4', decode_number, '>i4'),
+    'LWord'         : S7Type('LWord', 8, 'number', 'u8', decode_number, '>u8'),
+    'ULInt'         : S7Type('ULInt', 8, 'number', 'u8', decode_number, '>u8'),
+    'LInt'          : S7Type('LInt', 8, 'number', 'i8', decode_number, '>i8'),
+    'Real'          : S7Type('Real', 4, 'number', 'f4', decode_number, '>f4'),
+    'LReal'         : S7Type('LReal', 8, 'number', 'f8', decode_number, '>f8'),
+    'Char'          : S7Type('Char', 1, 'other', 'O', decode_char, '>u1'),
+    'WChar'         : S7Type('WChar', 2, 'other', 'O', decode_char, '>u2'),
+    'Time'          : S7Type('Time', 4, 'other', 'm8[ms]', decode_duration, '>i4', unit='ms'),
+    'LTime'         : S7Type('LTime', 8, 'other', 'm8[us]', decode_duration, '>i8', unit='ns'),
+    'Time_Of_Day'   : S7Type('Time_Of_Day', 4, 'other', 'm8[ms]', decode_duration, '>u4', unit='ms'),
+    'Date'          : S7Type('Date', 2, 'other', 'M8[D]', decode_date, '>u2'),
+    'DTL'           : S7Type('DTL', 12, 'other', 'M8[us]', decode_dtl),
+}
+s7_types['TOD'] = s7_types['Time_Of_Day']
+
+s7_string_pattern = re.compile(r'^(W?String)(?:\s*\[\s*(\d+)\s*\])?$')
+s7_array_pattern = re.compile(r'^Array\s*\[(.+)\]\s*of\s+(.+)$', re.IGNORECASE)
+
+def s7_type(data_type:str) -> S7Type:
+    '''Get the registry entry of a type, String[n] and WString[n] are registered on first use.
+    
+    Parameters
+    ----------
+    data_type : str
+        S7 type name.
+    
+    Returns
+    -------
+    S7Type
+        Registry entry.
+    '''
+    
+    entry = s7_types.get(data_type)
+    if entry is None:
+        match = s7_string_pattern.match(data_type.strip())
+        if match is None:
+            raise KeyError(f'Unsupported data type: {data_type}')
+        kind, max_length = match.group(1), int(match.group(2) or 254)
+        if kind == 'String':
+            entry = S7Type(data_type, 2 + max_length, 'other', 'O', decode_string, '>u1',
+                           header_size=2, max_length=max_length)
+        else:
+            entry = S7Type(data_type, 4 + 2*max_length, 'other', 'O', decode_string, '>u2',
+                           header_size=4, max_length=max_length)
+        s7_types[data_type] = entry
+    return entry
+
+def expand_layout(layout:dict, udts:dict=None) -> dict:
+    '''Expand arrays and UDT instances of a layout into their elements.\n
+    Array[lo..hi] of T rows (also multi-dimensional) become name[i] rows unless the
+    export already lists the elements. Rows typed with a quoted UDT name become
+    name.member rows of the UDT layout. Struct rows are containers, their members
+    are exported as rows of their own.
+    
+    Parameters
+    ----------
+    layout : dict
+        names, types, offsets and comments lists, see load_layout().
+    udts : dict, optional
+        UDT name -> layout of the UDT with offsets relative to its start.
+    
+    Returns
+    -------
+    dict
+        New layout with fixed-width types only.
+    '''
+    
+    udts = {} if udts is None else udts
+    expanded = {'names': [], 'types': [], 'offsets': [], 'comments': []}
+    listed_names = set(layout['names'])
+    
+    def add(name:str, data_type:str, offset:float, comment:str):
+        data_type = data_type.strip()
+        array = s7_array_pattern.match(data_type)
+        if data_type == 'Struct':
+            return
+        if data_type.startswith('"') and data_type.endswith('"'):
+            udt = udts[data_type.strip('"')]
+            byte_index, _ = split_offset(offset)
+            for member, member_type, member_offset, member_comment in zip(
+                    udt['names'], udt['types'], udt['offsets'], udt['comments']):
+                member_byte, member_bit = split_offset(member_offset)
+                add(f'{name}.{member}', member_type, byte_index + member_byte + member_bit/10, member_comment)
+        elif not array is None:
+            bounds = [[int(bound) for bound in dimension.split('..')] for dimension in array.group(1).split(',')]
+            element_type = array.group(2).strip()
+            byte_index, bit_index = split_offset(offset)
+            if element_type.startswith('"'):
+                # UDT elements start at even bytes
+                udt = udts[element_type.strip('"')]
+                element_size = max(split_offset(member_offset)[0] + s7_type(member_type).size
+                                   for member_type, member_offset in zip(udt['types'], udt['offsets']))
+                element_size += element_size % 2
+            elif element_type != 'Bool':
+                element_size = s7_type(element_type).size
+            for position, indexes in enumerate(itertools.product(*(range(low, high + 1) for low, high in bounds))):
+                element_name = f'{name}[{",".join(str(index) for index in indexes)}]'
+                if element_name in listed_names:
+                    continue
+                if element_type == 'Bool':
+                    # Bool arrays are packed, eight elements per byte
+                    bit = bit_index + position
+                    add(element_name, element_type, byte_index + bit//8 + (bit % 8)/10, comment)
+                else:
+                    add(element_name, element_type, float(byte_index + position*element_size), comment)
+        else:
+            expanded['names'].append(name)
+            expanded['types'].append(data_type)
+            expanded['offsets'].append(offset)
+            expanded['comments'].append(comment)
+            
+    for name, data_type, offset, comment in zip(layout['names'], layout['types'], layout['offsets'], layout['comments']):
+        add(name, data_type, offset, comment)
+    return expanded
+
+def analyze_layout(layout:dict) -> dict:
+    '''Compute the exact extent of every field and the smallest byte span covering them.
+
+    Fields are compared bit by bit, so Bools sharing a byte do not overlap.
+    
+    Parameters
+    ----------
+    layout : dict
+        names, types and offsets lists with fixed-width types, see expand_layout().
+    
+    Returns
+    -------
+    dict
+        field_starts and field_stops (datablock byte offsets, stop exclusive),
+        overlaps (pairs of tag names), offset_start, offset_stop, span,
+        used_bytes (bytes holding a field) and gap_bytes (bytes of the span holding none).
+    '''
+    
+    assert layout['names'], 'Empty datablock layout'
+    starts, stops, bit_ranges = [], [], []
+    for data_type, offset in zip(layout['types'], layout['offsets']):
+        s7type = s7_type(data_type)
+        byte_index, bit_index = split_offset(offset)
+        starts.append(byte_index)
+        stops.append(byte_index + s7type.size)
+        if s7type.kind == 'bool':
+            bit_ranges.append((byte_index*8 + bit_index, byte_index*8 + bit_index + 1))
+        else:
+            bit_ranges.append((byte_index*8, (byte_index + s7type.size)*8))
+            
+    overlaps = []
+    previous = None
+    for slot in sorted(range(len(bit_ranges)), key=lambda slot: bit_ranges[slot]):
+        if not previous is None and bit_ranges[slot][0] < bit_ranges[previous][1]:
+            overlaps.append((layout['names'][previous], layout['names'][slot]))
+        if previous is None or bit_ranges[slot][1] > bit_ranges[previous][1]:
+            previous = slot
+            
+    offset_start, offset_stop = min(starts), max(stops)
+    used = np.zeros(offset_stop - offset_start, dtype=np.bool_)
+    for start, stop in zip(starts, stops):
+        used[start - offset_start:stop - offset_start] = True
+    return {
+        'field_starts' : starts,
+        'field_stops'  : stops,
+        'overlaps'     : overlaps,
+        'offset_start' : offset_start,
+        'offset_stop'  : offset_stop,
+        'span'         : offset_stop - offset_start,
+        'used_bytes'   : int(used.sum()),
+        'gap_bytes'    : int(used.size - used.sum()),
+    }
+
+def file_sha256(path:str) -> str:
+    '''Compute the SHA-256 hash of a file.
+    
+    Parameters
+    ----------
+    path : str
+        Path to a file.
+    
+    Returns
+    -------
+    str
+        Hex digest of the file content.
+    '''
+    
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def parse_layout(config_file_path:str) -> dict:
+    '''Parse the datablock layout from the .xlsx config file.
+    
+    Parameters
+    ----------
+    config_file_path : str
+        A path to the s7 plc data block configuration file in .xlsx format.
+    
+    Returns
+    -------
+    dict
+        names, types, offsets and comments lists in the layout order.
+    '''
+    
+    # pandas and openpyxl are imported only when a config file has to be parsed
+    import pandas as pd
+    df_layout = pd.read_excel(config_file_path, usecols=layout_columns)
+    return {
+        'names'    : [str(name) for name in df_layout['Name']],
+        'types'    : [str(data_type) for data_type in df_layout['Data type']],
+        'offsets'  : [float(offset) for offset in df_layout['Offset']],
+        'comments' : ['' if pd.isna(comment) else str(comment) for comment in df_layout['Comment']],
+    }
+
+def layout_cache_path(config_file_path:str, cache_dir:str=None) -> str:
+    '''
+    Path to the compiled layout of a config file, next to the file if no cache_dir is given
+    '''
+    directory, file_name = os.path.split(os.path.abspath(config_file_path))
+    return os.path.join(directory if cache_dir is None else cache_dir, f'.{file_name}.layout.json')
+
+def load_layout(config_file_path:str, cache_dir:str=None) -> dict:
+    '''Load the datablock layout, parsed once and cached.\n
+    The cache is keyed by the SHA-256 of the config file,
+    so any change of the file invalidates it.
+    
+    Parameters
+    ----------
+    config_file_path : str
+        A path to the s7 plc data block configuration file in .xlsx format.
+    cache_dir : str, optional
+        Directory of the cache, defaults to the one of the config file.
+    
+    Returns
+    -------
+    dict
+        names, types, offsets and comments lists in the layout order.
+    '''
+    
+    source_sha256 = file_sha256(config_file_path)
+    cache_path = layout_cache_path(config_file_path, cache_dir)
+    try:
+        with open(cache_path, 'r') as cache_file:
+            layout = json.load(cache_file)
+        if layout.get('version') == layout_cache_version and layout.get('source_sha256') == source_sha256:
+            return layout
+    except (OSError, ValueError):
+        pass
+    
+    layout = parse_layout(config_file_path)
+    layout['version'] = layout_cache_version
+    layout['source_sha256'] = source_sha256
+    try:
+        # Write to a temporary file first, concurrent brokers never read a partial cache
+        temporary_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as cache_file:
+            json.dump(layout, cache_file)
+        os.replace(temporary_path, cache_path)
+    except OSError:
+        print(f'Could not write the layout cache on path: {cache_path}')
+    return layout
+
+def load_frame_log(path:str) -> np.ndarray:
+    '''Load a whole text frame log in one pass.\n
+    Every line holds a single s7frame written by Broker.log().
+    
+    Parameters
+    ----------
+    path : str
+        Path to a file containing logged s7 frames.
+    
+    Returns
+    -------
+    np.ndarray
+        2-D uint8 array, one row per frame.
+    
+    Raises
+    ------
+    ValueError
+        If a line holds anything but byte values or a different number of them than the first line.
+    '''
+    
+    with open(path, 'rb') as log_file:
+        text = np.frombuffer(log_file.read(), dtype=np.uint8)
+    line_ends = np.flatnonzero(text == ord('\n'))
+    def line_of(position:int) -> int:
+        return int(np.searchsorted(line_ends, position)) + 1
+    
+    # Numbers are parsed in place, the units, tens and hundreds of all the values at once
+    digits = (text >= ord('0')) & (text <= ord('9'))
+    separators = (text == ord(' ')) | (text == ord('\t')) | (text == ord('\r')) | (text == ord('\n'))
+    invalid = np.flatnonzero(~(digits | separators))
+    if invalid.size:
+        raise ValueError(f'Invalid character on line {line_of(invalid[0])} of the file on path: {path}')
+    first_digits, last_digits = digits.copy(), digits.copy()
+    first_digits[1:] &= ~digits[:-1]
+    last_digits[:-1] &= ~digits[1:]
+    starts, lasts = np.flatnonzero(first_digits), np.flatnonzero(last_digits)
+    lengths = lasts - starts + 1
+    values = text[lasts].astype(np.int16) - ord('0')
+    values += np.where(lengths > 1, text[lasts - 1].astype(np.int16) - ord('0'), 0)*10
+    values += np.where(lengths > 2, text[lasts - 2].astype(np.int16) - ord('0'), 0)*100
+    too_large = np.flatnonzero((lengths > 3) | (values > 255))
+    if too_large.size:
+        raise ValueError(f'Value out of the byte range on line {line_of(starts[too_large[0]])} of the file on path: {path}')
+    
+    # Blank lines are skipped, every other line holds a whole s7frame
+    line_starts = np.concatenate(([0], np.searchsorted(starts, line_ends), [starts.size]))
+    line_sizes = np.diff(line_starts)
+    frame_lines = np.flatnonzero(line_sizes)
+    if frame_lines.size == 0:
+        raise ValueError(f'No frames in the file on path: {path}')
+    frame_size = line_sizes[frame_lines[0]]
+    unequal = frame_lines[line_sizes[frame_lines] != frame_size]
+    if unequal.size:
+        raise ValueError(f'Line {unequal[0] + 1} holds {line_sizes[unequal[0]]} bytes instead of {frame_size} '
+                         f'in the file on path: {path}')
+    return values.astype(np.uint8).reshape(-1, frame_size)
+
+
+class FrameDecoder:
+    '''FrameDecoder class\n
+    Decoder compiled once from a datablock layout.
+    Fields are grouped by their s7 type, so a whole s7frame is decoded
+    with a few NumPy calls no matter how many tags the datablock has.
+    
+    Parameters
+    ----------
+    names : list of str
+        Tag names in the layout order.
+    types : list of str
+        S7 data types in the layout order.
+    offsets : list of float
+        Offsets in the layout order.
+    base : int
+        Datablock offset of the first byte of a decoded s7frame.
+        
+    Attributes
+    ----------
+    names : list of str
+        Tag names in the layout order.
+    types : list of str
+        S7 data types in the layout order.
+    index : dict
+        Tag name -> slot in the decoded values.
+    size : int
+        Number of tags.
+    base : int
+        Datablock offset of the first byte of a decoded s7frame.
+    groups : list of tuple
+        (slots, byte index table, S7Type) for every byte-aligned type.
+    bool_slots : np.ndarray
+        Output slots of the Bool tags.
+    bool_bytes : np.ndarray
+        Byte indexes of the Bool tags.
+    bool_masks : np.ndarray
+        Bit masks of the Bool tags.
+    field_starts : np.ndarray
+        First s7frame byte of every tag.
+    field_stops : np.ndarray
+        s7frame byte after every tag.
+    '''
+    
+    def __init__(self, names:list, types:list, offsets:list, base:int=0):
+        self.names = list(names)
+        self.types = list(types)
+        self.index = {name: slot for slot, name in enumerate(self.names)}
+        self.size = len(self.names)
+        self.base = base
+        self.groups = []
+        
+        typed_fields = {}
+        bool_slots, bool_bytes, bool_masks = [], [], []
+        self.field_starts = np.zeros(self.size, dtype=np.intp)
+        self.field_stops = np.zeros(self.size, dtype=np.intp)
+        for slot, (data_type, offset) in enumerate(zip(self.types, offsets)):
+            s7type = s7_type(data_type)
+            byte_index, bit_index = split_offset(offset)
+            byte_index -= base
+            self.field_starts[slot] = byte_index
+            self.field_stops[slot] = byte_index + s7type.size
+            if s7type.kind == 'bool':
+                bool_slots.append(slot)
+                bool_bytes.append(byte_index)
+                bool_masks.append(1 << bit_index)
+            else:
+                typed_fields.setdefault(s7type.name, []).append((slot, byte_index))
+        
+        # Every byte-aligned type gets a (tags x width) table of byte indexes
+        for data_type, fields in typed_fields.items():
+            s7type = s7_type(data_type)
+            slots = np.array([slot for slot, _ in fields], dtype=np.intp)
+            starts = np.array([byte_index for _, byte_index in fields], dtype=np.intp)
+            index = starts[:, None] + np.arange(s7type.size, dtype=np.intp)
+            self.groups.append((slots, index, s7type))
+        self.bool_slots = np.array(bool_slots, dtype=np.intp)
+        self.bool_bytes = np.array(bool_bytes, dtype=np.intp)
+        self.bool_masks = np.array(bool_masks, dtype=np.uint8)
+        
+    def decode(self, s7frame:bytearray, out:np.ndarray=None) -> np.ndarray:
+        '''Decode all the tags of a single s7frame.
+        
+        Parameters
+        ----------
+        s7frame : bytearray
+            S7 protocol frame.
+        out : np.ndarray, optional
+            Object array of the decoder size to be filled.
+        
+        Returns
+        -------
+        np.ndarray
+            Object array with the values in the layout order.
+        '''
+        
+        frame = np.frombuffer(s7frame, dtype=np.uint8)
+        values = np.empty(self.size, dtype=object) if out is None else out
+        for slots, index, s7type in self.groups:
+            values[slots] = s7type.decode(frame[index])
+        if self.bool_slots.size:
+            values[self.bool_slots] = decode_bool(frame[self.bool_bytes], None, self.bool_masks)
+        return values
+    
+    def decode_changed(self, s7frame:bytearray, previous_frame:bytearray, previous_values:np.ndarray) -> np.ndarray:
+        '''Decode only the tags whose bytes differ from the previous s7frame.
+        
+        Parameters
+        ----------
+        s7frame : bytearray
+            S7 protocol frame.
+        previous_frame : bytearray
+            The previous s7frame.
+        previous_values : np.ndarray
+            Values decoded from the previous s7frame, left untouched.
+        
+        Returns
+        -------
+        np.ndarray
+            New object array with the values in the layout order.
+        None
+            If the s7frames are identical.
+        '''
+        
+        if len(s7frame) != len(previous_frame):
+            return self.decode(s7frame)
+        if memoryview(s7frame) == memoryview(previous_frame):
+            return None
+        frame = np.frombuffer(s7frame, dtype=np.uint8)
+        # A tag is dirty if any of its bytes changed
+        changed_bytes = np.concatenate(([0], np.cumsum(frame != np.frombuffer(previous_frame, dtype=np.uint8))))
+        dirty = changed_bytes[self.field_stops] != changed_bytes[self.field_starts]
+        values = previous_values.copy()
+        for slots, index, s7type in self.groups:
+            mask = dirty[slots]
+            if mask.any():
+                values[slots[mask]] = s7type.decode(frame[index[mask]])
+        if self.bool_slots.size:
+            mask = dirty[self.bool_slots]
+            if mask.any():
+                values[self.bool_slots[mask]] = decode_bool(frame[self.bool_bytes[mask]], None, self.bool_masks[mask])
+        return values
+    
+    def decode_batch(self, frames:np.ndarray) -> dict:
+        '''Decode all the tags of many s7frames at once.
+        
+        Parameters
+        ----------
+        frames : np.ndarray
+            2-D uint8 array, one row per s7frame, e.g. from load_frame_log().
+        
+        Returns
+        -------
+        dict
+            Tag name -> typed column with one value per frame, in the layout order.
+        '''
+        
+        frames = np.asarray(frames, dtype=np.uint8)
+        columns = {}
+        for slots, index, s7type in self.groups:
+            # (frames x tags x width) bytes -> (tags x frames) native values
+            block = s7type.decode(np.take(frames, index, axis=1)).T.copy()
+            for row, slot in enumerate(slots):
+                columns[self.names[slot]] = block[row]
+        if self.bool_slots.size:
+            block = decode_bool(np.take(frames, self.bool_bytes, axis=1), None, self.bool_masks).T.copy()
+            for row, slot in enumerate(self.bool_slots):
+                columns[self.names[slot]] = block[row]
+        return {name: columns[name] for name in self.names}
+
+
+class Snapshot:
+    '''Snapshot class\n
+    Immutable set of decoded values published by a broker.
+    The name -> slot index is computed once and shared by all the snapshots,
+    a dataframe is built only if a consumer asks for it.
+    
+    Parameters
+    ----------
+    names : list of str
+        Tag names in the layout order.
+    index : dict
+        Tag name -> slot in the values.
+    values : np.ndarray
+        Decoded values in the layout order.
+    seq : int or None
+        Sequence number of the sample, None before the first sample.
+    timestamp_ns : int or None
+        Wall-clock time of the sample in ns.
+    changed : np.ndarray or None
+        Slots changed since the last published sample, None for a full snapshot.
+    stamp : ReadStamp or None
+        Clocks around the read of the sample.
+    '''
+    
+    __slots__ = ('names', 'index', 'values', 'seq', 'timestamp_ns', 'changed', 'stamp', 'frame')
+    
+    def __init__(self, names:list, index:dict, values:np.ndarray, seq:int=None, timestamp_ns:int=None,
+                 changed:np.ndarray=None, stamp:ReadStamp=None):
+        self.names = names
+        self.index = index
+        self.values = values
+        self.seq = seq
+        self.timestamp_ns = timestamp_ns
+        self.changed = changed
+        self.stamp = stamp
+        self.frame = None
+        
+    def __getitem__(self, name:str):
+        return self.values[self.index[name]]
+    
+    def __contains__(self, name:str):
+        return name in self.index
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def get(self, name:str, default=None):
+        slot = self.index.get(name)
+        return default if slot is None else self.values[slot]
+    
+    def to_dict(self) -> dict:
+        '''
+        Get a tag name -> value dictionary
+        '''
+        return dict(zip(self.names, self.values))
+    
+    def has_changes(self) -> bool:
+        '''
+        False if the sample is a change-of-value sample without any change
+        '''
+        return self.changed is None or len(self.changed) > 0
+    
+    def changes(self) -> dict:
+        '''
+        Get a tag name -> value dictionary of the changed tags, all the tags for a full snapshot
+        '''
+        if self.changed is None:
+            return self.to_dict()
+        return {self.names[slot]: self.values[slot] for slot in self.changed}
+    
+    def absorb(self, dropped:'Snapshot') -> 'Snapshot':
+        '''
+        Get this snapshot reporting also the changes of an older snapshot dropped from a queue,
+        the change filter has moved past them and would not report them again
+        '''
+        if self.changed is None:
+            return self
+        changed = None if dropped.changed is None else np.union1d(dropped.changed, self.changed)
+        return Snapshot(self.names, self.index, self.values, self.seq, self.timestamp_ns, changed, self.stamp)
+    
+    def header(self) -> dict:
+        '''
+        Get the sequence number and the read stamps of the sample, e.g. for a published message
+        '''
+        header = {'seq': self.seq, 'timestamp_ns': self.timestamp_ns}
+        if not self.stamp is None:
+            header.update(self.stamp._asdict())
+        return header
+    
+    def to_frame(self) -> 'pd.DataFrame':
+        '''
+        Get the values as a dataframe indexed by Name with a Value column, built once per snapshot
+        '''
+        if self.frame is None:
+            import pandas as pd
+            self.frame = pd.DataFrame({'Value': self.values}, index=pd.Index(self.names, name='Name'))
+        return self.frame
+
+
+class ChangeFilter:
+    '''ChangeFilter class\n
+    Change-of-value detection for the decoded samples.
+    Numeric tags change once they leave the absolute or the percent
+    deadband around the last published value, Bool tags change on every edge
+    and the other types (strings, times, dates) on every new value.
+    A full snapshot is requested on every heartbeat.
+    
+    Parameters
+    ----------
+    names : list of str
+        Tag names in the layout order.
+    types : list of str
+        S7 data types in the layout order.
+    abs_deadband : float or dict
+        Absolute deadband, a tag name -> deadband dictionary defaults missing tags to 0.
+    pct_deadband : float or dict
+        Deadband in percent of the last published value, same as above.
+    heartbeat_s : float or None
+        Period of the full snapshots in seconds, None disables them.
+        
+    Attributes
+    ----------
+    heartbeat_s : float or None
+        Period of the full snapshots in seconds.
+    numeric_slots : np.ndarray
+        Slots of the numeric tags.
+    bool_slots : np.ndarray
+        Slots of the Bool tags.
+    other_slots : np.ndarray
+        Slots of the remaining tags.
+    last_values : np.ndarray or None
+        Last published values of the numeric tags.
+    last_bools : np.ndarray or None
+        Last published values of the Bool tags.
+    last_others : np.ndarray or None
+        Last published values of the remaining tags.
+    last_full : float or None
+        Monotonic time of the last full snapshot.
+    '''
+    
+    def __init__(self, names:list, types:list, abs_deadband=0.0, pct_deadband=0.0, heartbeat_s:float=60.0):
+        self.heartbeat_s = heartbeat_s
+        kinds = [s7_type(data_type).kind for data_type in types]
+        self.numeric_slots = np.array([slot for slot, kind in enumerate(kinds) if kind == 'number'], dtype=np.intp)
+        self.bool_slots = np.array([slot for slot, kind in enumerate(kinds) if kind == 'bool'], dtype=np.intp)
+        self.other_slots = np.array([slot for slot, kind in enumerate(kinds) if kind == 'other'], dtype=np.intp)
+        numeric_names = [names[slot] for slot in self.numeric_slots]
+        self.abs_deadband = self.deadband_table(abs_deadband, numeric_names)
+        self.pct_deadband = self.deadband_table(pct_deadband, numeric_names)/100
+        self.last_values = None
+        self.last_bools = None
+        self.last_others = None
+        self.last_full = None
+        
+    def heartbeat_due(self, now:float) -> bool:
+        '''
+        True if the next update returns a full snapshot
+        '''
+        return self.last_full is None or (not self.heartbeat_s is None and now - self.last_full >= self.heartbeat_s)
+        
+    @staticmethod
+    def deadband_table(deadband, names:list) -> np.ndarray:
+        '''
+        Expand a scalar or a tag name -> deadband dictionary into an array
+        '''
+        if isinstance(deadband, dict):
+            return np.array([deadband.get(name, 0.0) for name in names], dtype=np.float64)
+        return np.full(len(names), deadband, dtype=np.float64)
+        
+    def update(self, values:np.ndarray, now:float) -> np.ndarray:
+        '''Detect the changed tags and remember their values as published.
+        
+        Parameters
+        ----------
+        values : np.ndarray
+            Decoded values in the layout order.
+        now : float
+            Monotonic time in seconds.
+        
+        Returns
+        -------
+        np.ndarray
+            Sorted slots of the changed tags.
+        None
+            If a full snapshot is due.
+        '''
+        
+        numeric = values[self.numeric_slots].astype(np.float64)
+        bools = values[self.bool_slots].astype(np.bool_)
+        others = values[self.other_slots]
+        if self.heartbeat_due(now):
+            self.last_values, self.last_bools, self.last_others, self.last_full = numeric, bools, others, now
+            return None
+        deadband = np.maximum(self.abs_deadband, self.pct_deadband*np.abs(self.last_values))
+        numeric_changed = np.abs(numeric - self.last_values) > deadband
+        numeric_changed |= np.isnan(numeric) != np.isnan(self.last_values)
+        bool_changed = bools != self.last_bools
+        other_changed = np.array([value != last for value, last in zip(others, self.last_others)], dtype=np.bool_)
+        self.last_values[numeric_changed] = numeric[numeric_changed]
+        self.last_bools[bool_changed] = bools[bool_changed]
+        self.last_others[other_changed] = others[other_changed]
+        return np.sort(np.concatenate((
+                                       self.numeric_slots[numeric_changed],
+                                       self.bool_slots[bool_changed],
+                                       self.other_slots[other_changed]
+                                       )))
+
+
+def frame_log_dtype(frame_size:int, version:int=frame_log_version) -> np.dtype:
+    '''Get the NumPy record type of a binary frame log.
+    
+    Parameters
+    ----------
+    frame_size : int
+        Number of bytes in a single s7frame.
+    version : int
+        Version of the log format.
+    
+    Returns
+    -------
+    np.dtype
+        Packed record type, version 1 with timestamp_ns, datablock and frame fields,
+        version 2 with the ReadStamp fields, datablock and frame.
+    '''
+    
+    if version == 1:
+        stamp_fields = [('timestamp_ns', '<i8')]
+    else:
+        stamp_fields = [(field, '<i8') for field in ReadStamp._fields]
+    return np.dtype(stamp_fields + [
+        ('datablock', '<u2'),
+        ('frame', 'u1', (frame_size,)),
+    ])
+
+def read_frame_log_header(path:str) -> dict:
+    '''Read the header of a binary frame log.
+    
+    Parameters
+    ----------
+    path : str
+        Path to a binary frame log.
+    
+    Returns
+    -------
+    dict
+        version, frame_size, created_ns and created_monotonic_ns.
+    None
+        If the file is not a binary frame log.
+    '''
+    
+    with open(path, 'rb') as log_file:
+        header = log_file.read(frame_log_header.size)
+    if len(header) < frame_log_header.size or header[:4] != frame_log_magic:
+        return None
+    _, version, frame_size, created_ns, created_monotonic_ns = frame_log_header.unpack(header)
+    return {
+        'version'              : version,
+        'frame_size'           : frame_size,
+        'created_ns'           : created_ns,
+        'created_monotonic_ns' : created_monotonic_ns,
+    }
+
+def load_binary_frame_log(path:str) -> np.ndarray:
+    '''Load all the records of a binary frame log with a single read.
+    
+    Parameters
+    ----------
+    path : str
+        Path to a binary frame log.
+    
+    Returns
+    -------
+    np.ndarray
+        Structured array, see frame_log_dtype(). Frames are views into it.
+    '''
+    
+    header = read_frame_log_header(path)
+    if header is None:
+        raise ValueError(f'Not a binary frame log: {path}')
+    dtype = frame_log_dtype(header['frame_size'], header['version'])
+    records = np.fromfile(path, dtype=np.uint8, offset=frame_log_header.size)
+    # Drop a record torn by an interrupted write
+    records = records[:records.size - records.size % dtype.itemsize]
+    return records.view(dtype)
+
+
+class FrameLogWriter:
+    '''FrameLogWriter class\n
+    Append-only binary log of raw s7frames with fixed-size records.
+    The file stays open and writes are buffered.
+    
+    Parameters
+    ----------
+    path : str
+        Path to the log file, an existing log is appended unless the monotonic clock
+        has restarted since it was created, it is then renamed and a new log started.
+    frame_size : int or None
+        Number of bytes in a single s7frame, None takes it from the first frame.
+    fsync_every : int
+        Flush and fsync after every n records, 0 leaves it to the OS.
+    buffer_size : int
+        Size of the write buffer in bytes.
+        
+    Attributes
+    ----------
+    path : str
+        Path to the log file.
+    frame_size : int or None
+        Number of bytes in a single s7frame.
+    fsync_every : int
+        Flush and fsync after every n records.
+    records_written : int
+        Number of records written by this writer.
+    version : int
+        Version of the log format, an existing log keeps its own.
+    '''
+    
+    def __init__(self, path:str, frame_size:int=None, fsync_every:int=0, buffer_size:int=65536):
+        self.path = path
+        self.version = frame_log_version
+        self.frame_size = frame_size
+        self.fsync_every = fsync_every
+        self.buffer_size = buffer_size
+        self.records_written = 0
+        self.log_file = None
+        
+    def open(self, frame_size:int):
+        '''
+        Open the file, write the header of a new log or check the one of an existing log
+        '''
+        log_exists = os.path.isfile(self.path) and os.path.getsize(self.path) > 0
+        header = read_frame_log_header(self.path) if log_exists else None
+        if log_exists and header is None:
+            raise ValueError(f'Not a binary frame log: {self.path}')
+        if not header is None and header['frame_size'] != frame_size:
+            raise ValueError(f'Frame size {frame_size} differs from the log: {header["frame_size"]}')
+        if not header is None and self.clock_base_changed(header):
+            # Monotonic timestamps of one log never go backwards, the anchor of its header stays valid
+            root, extension = os.path.splitext(self.path)
+            rotated_path = f'{root}.{header["created_ns"]}{extension}'
+            os.replace(self.path, rotated_path)
+            print(f'FrameLog> Clock base changed, {self.path} moved to {rotated_path}')
+            header = None
+        self.frame_size = frame_size
+        self.version = frame_log_version if header is None else header['version']
+        self.log_file = open(self.path, 'ab', buffering=self.buffer_size)
+        if header is None:
+            self.log_file.write(frame_log_header.pack(
+                                                    frame_log_magic,
+                                                    frame_log_version,
+                                                    frame_size,
+                                                    time.time_ns(),
+                                                    time.monotonic_ns()
+                                                    ))
+        
+    def clock_base_changed(self, header:dict) -> bool:
+        '''
+        True if the monotonic clock of the log is not the current one
+        '''
+        now_ns, now_monotonic_ns = time.time_ns(), time.monotonic_ns()
+        log_anchor_ns = header['created_ns'] - header['created_monotonic_ns']
+        if abs((now_ns - now_monotonic_ns) - log_anchor_ns) > frame_log_clock_tolerance_ns:
+            return True
+        record_header = frame_log_record_headers[header['version']]
+        record_size = record_header.size + header['frame_size']
+        records = (os.path.getsize(self.path) - frame_log_header.size)//record_size
+        if records == 0:
+            return header['created_monotonic_ns'] > now_monotonic_ns
+        with open(self.path, 'rb') as log_file:
+            log_file.seek(frame_log_header.size + (records - 1)*record_size)
+            record = record_header.unpack(log_file.read(record_header.size))
+        return record[frame_log_monotonic_fields[header['version']]] > now_monotonic_ns
+        
+    def write(self, s7frame:bytearray, datablock_number:int, stamp:ReadStamp=None):
+        '''
+        Append a single record, the stamp defaults to now.
+        Version 1 logs keep the monotonic time of the request only.
+        '''
+        if self.log_file is None:
+            self.open(len(s7frame) if self.frame_size is None else self.frame_size)
+        if len(s7frame) != self.frame_size:
+            raise ValueError(f'Frame size {len(s7frame)} differs from the log: {self.frame_size}')
+        if stamp is None:
+            stamp = ReadStamp.now()
+        if self.version == 1:
+            record_header = frame_log_record_headers[1].pack(stamp.request_monotonic_ns, datablock_number)
+        else:
+            record_header = frame_log_record_headers[2].pack(*stamp, datablock_number)
+        self.log_file.write(record_header)
+        self.log_file.write(s7frame)
+        self.records_written += 1
+        if self.fsync_every and self.records_written % self.fsync_every == 0:
+            self.sync()
+            
+    def sync(self):
+        '''
+        Flush the buffer and fsync the file
+        '''
+        if not self.log_file is None:
+            self.log_file.flush()
+            os.fsync(self.log_file.fileno())
+        
+    def close(self):
+        if not self.log_file is None:
+            self.sync()
+            self.log_file.close()
+            self.log_file = None
+            
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FrameLog:
+    '''FrameLog class\n
+    Memory-mapped, read-only view of a binary frame log.
+    Records are fixed-size, so a frame index is reached in O(1)
+    and only the touched pages are ever read from the disk.
+    
+    Parameters
+    ----------
+    path : str
+        Path to a binary frame log.
+        
+    Attributes
+    ----------
+    path : str
+        Path to a binary frame log.
+    header : dict
+        Log header, see read_frame_log_header().
+    records : np.ndarray
+        Memory-mapped structured array, see frame_log_dtype().
+    timestamps : np.ndarray
+        Monotonic timestamps of the requests in ns, a view of the records.
+    wall_timestamps : np.ndarray or None
+        Wall-clock timestamps of the requests in ns, None for version 1 logs.
+    frames : np.ndarray
+        Raw s7frames, a view of the records.
+    '''
+    
+    def __init__(self, path:str):
+        self.path = path
+        self.header = read_frame_log_header(path)
+        if self.header is None:
+            raise ValueError(f'Not a binary frame log: {path}')
+        dtype = frame_log_dtype(self.header['frame_size'], self.header['version'])
+        count = (os.path.getsize(path) - frame_log_header.size)//dtype.itemsize
+        if count:
+            self.records = np.memmap(path, dtype=dtype, mode='r', offset=frame_log_header.size, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=dtype)
+        if self.header['version'] == 1:
+            self.timestamps = self.records['timestamp_ns']
+            self.wall_timestamps = None
+        else:
+            self.timestamps = self.records['request_monotonic_ns']
+            self.wall_timestamps = self.records['request_ns']
+        self.frames = self.records['frame']
+        
+    def __len__(self):
+        return len(self.records)
+    
+    def __getitem__(self, index):
+        return self.records[index]
+    
+    def to_monotonic_ns(self, wall_clock_ns:int) -> int:
+        '''
+        Convert a wall-clock timestamp to the monotonic clock of the log
+        '''
+        return wall_clock_ns - self.header['created_ns'] + self.header['created_monotonic_ns']
+    
+    def stamp(self, record:np.void) -> ReadStamp:
+        '''
+        Read stamp of a record, None for version 1 logs
+        '''
+        if self.wall_timestamps is None:
+            return None
+        return ReadStamp(*(int(record[field]) for field in ReadStamp._fields))
+    
+    def index_at(self, timestamp_ns:int, wall_clock:bool=False) -> int:
+        '''Find the first frame logged at or after the timestamp.\n
+        The position is interpolated from the first and the last timestamp,
+        which for evenly polled logs lands next to the frame right away,
+        then refined by a binary search in a growing window.
+        
+        Parameters
+        ----------
+        timestamp_ns : int
+            Monotonic timestamp of the log or wall-clock time in ns.
+        wall_clock : bool
+            True if the timestamp refers to the wall-clock, version 1 logs
+            convert it with the clocks of the header.
+        
+        Returns
+        -------
+        int
+            Frame index, len(self) if all the frames are older.
+        '''
+        
+        timestamps = self.timestamps
+        if wall_clock and self.wall_timestamps is None:
+            timestamp_ns = self.to_monotonic_ns(timestamp_ns)
+        elif wall_clock:
+            timestamps = self.wall_timestamps
+        count = len(self)
+        if count == 0 or timestamp_ns <= timestamps[0]:
+            return 0
+        if timestamp_ns > timestamps[-1]:
+            return count
+        first, last = int(timestamps[0]), int(timestamps[-1])
+        guess = (timestamp_ns - first)*(count - 1)//max(last - first, 1)
+        window = 8
+        while True:
+            low, high = max(guess - window, 0), min(guess + window, count)
+            if (low == 0 or timestamps[low - 1] < timestamp_ns) and \
+               (high == count or timestamps[high - 1] >= timestamp_ns):
+                return low + int(np.searchsorted(timestamps[low:high], timestamp_ns))
+            window *= 8
+            
+    def window(self, start_ns:int=None, stop_ns:int=None, wall_clock:bool=False) -> np.ndarray:
+        '''
+        Get records logged within [start_ns, stop_ns), a view without copying
+        '''
+        start = 0 if start_ns is None else self.index_at(start_ns, wall_clock)
+        stop = len(self) if stop_ns is None else self.index_at(stop_ns, wall_clock)
+        return self.records[start:stop]
+
+
+class ReadPlanner:
+    '''ReadPlanner class\n
+    Coalesces tags of many datablocks and memory areas into a minimal set of
+    S7 requests. Nearby ranges are merged when the gap is cheaper to read than
+    an extra request item, ranges are split at the negotiated PDU size and
+    packed into read_multi_vars batches.
+    
+    Parameters
+    ----------
+    tags : list of ReadRange
+        Byte ranges of the tags, area is a key of s7_areas.
+    pdu_size : int
+        PDU size negotiated with the PLC.
+    max_gap : int or None
+        Longest gap in bytes to read through, None uses the cost of an extra item.
+        
+    Attributes
+    ----------
+    tags : list of ReadRange
+        Byte ranges of the tags.
+    pdu_size : int
+        PDU size negotiated with the PLC.
+    max_gap : int
+        Longest gap in bytes to read through.
+    ranges : list of ReadRange
+        Merged and split ranges to be read.
+    batches : list of list
+        Ranges sent within a single request.
+    blocks : dict
+        (area, dbnumber) -> (start, stop) of the image built by execute().
+    '''
+    
+    def __init__(self, tags:list, pdu_size:int=240, max_gap:int=None):
+        self.tags = [ReadRange(*tag) for tag in tags]
+        self.max_gap = s7_read_request_item + s7_read_response_item if max_gap is None else max_gap
+        self.change_pdu_size(pdu_size)
+        
+    def change_pdu_size(self, pdu_size:int):
+        '''
+        Plan the requests for a PDU size, e.g. the one negotiated on connect
+        '''
+        self.pdu_size = pdu_size
+        self.ranges = self.split_ranges(self.merge_ranges(self.tags))
+        self.batches = self.pack_batches(self.ranges)
+        self.blocks = {}
+        for read_range in self.ranges:
+            key = (read_range.area, read_range.dbnumber)
+            start, stop = self.blocks.get(key, (read_range.start, read_range.start + read_range.size))
+            self.blocks[key] = (min(start, read_range.start), max(stop, read_range.start + read_range.size))
+        
+    def merge_ranges(self, tags:list) -> list:
+        '''
+        Merge overlapping ranges and ranges separated by at most max_gap bytes
+        '''
+        ranges = []
+        for tag in sorted(tags):
+            last = ranges[-1] if ranges else None
+            if not last is None and (last.area, last.dbnumber) == (tag.area, tag.dbnumber) \
+               and tag.start <= last.start + last.size + self.max_gap:
+                stop = max(last.start + last.size, tag.start + tag.size)
+                ranges[-1] = last._replace(size=stop - last.start)
+            else:
+                ranges.append(tag)
+        return ranges
+    
+    def max_item_size(self) -> int:
+        '''
+        Largest even amount of bytes a single item can return within the PDU
+        '''
+        return (self.pdu_size - s7_read_response_header - s7_read_response_item) & ~1
+    
+    def split_ranges(self, ranges:list) -> list:
+        '''
+        Split ranges not fitting into a single response
+        '''
+        max_size = self.max_item_size()
+        assert max_size > 0
+        split = []
+        for read_range in ranges:
+            for offset in range(0, read_range.size, max_size):
+                split.append(read_range._replace(
+                                                start=read_range.start + offset,
+                                                size=min(max_size, read_range.size - offset)
+                                                ))
+        return split
+    
+    def pack_batches(self, ranges:list) -> list:
+        '''
+        Pack ranges into requests, both the request and the response must fit the PDU
+        '''
+        batches = []
+        request_size = response_size = self.pdu_size
+        for read_range in ranges:
+            item_response = s7_read_response_item + read_range.size + read_range.size % 2
+            if not batches or len(batches[-1]) == s7_max_read_items \
+               or request_size + s7_read_request_item > self.pdu_size \
+               or response_size + item_response > self.pdu_size:
+                batches.append([])
+                request_size = s7_read_request_header
+                response_size = s7_read_response_header
+            batches[-1].append(read_range)
+            request_size += s7_read_request_item
+            response_size += item_response
+        return batches
+    
+    def cost(self) -> dict:
+        '''Count the bytes the plan puts on the wire.
+        
+        Returns
+        -------
+        dict
+            requests, items, read_bytes (payload requested), used_bytes (payload holding a tag),
+            wasted_bytes (gaps read through and odd-size padding) and overhead_bytes
+            (S7 headers of the requests and responses).
+        '''
+        
+        used = 0
+        for read_range in self.merge_ranges_exact(self.tags):
+            used += read_range.size
+        read_bytes = sum(read_range.size for read_range in self.ranges)
+        padding = sum(read_range.size % 2 for read_range in self.ranges)
+        overhead = sum(
+                       s7_read_request_header + s7_read_response_header
+                       + len(batch)*(s7_read_request_item + s7_read_response_item)
+                       for batch in self.batches
+                       )
+        return {
+            'requests'       : len(self.batches),
+            'items'          : len(self.ranges),
+            'read_bytes'     : read_bytes,
+            'used_bytes'     : used,
+            'wasted_bytes'   : read_bytes - used + padding,
+            'overhead_bytes' : overhead,
+        }
+    
+    @staticmethod
+    def merge_ranges_exact(tags:list) -> list:
+        '''
+        Merge overlapping and adjacent ranges only, the bytes holding tags
+        '''
+        ranges = []
+        for tag in sorted(tags):
+            last = ranges[-1] if ranges else None
+            if not last is None and (last.area, last.dbnumber) == (tag.area, tag.dbnumber) \
+               and tag.start <= last.start + last.size:
+                stop = max(last.start + last.size, tag.start + tag.size)
+                ranges[-1] = last._replace(size=stop - last.start)
+            else:
+                ranges.append(tag)
+        return ranges
+    
+    def read_batch(self, plc_client:snap7.client.Client, batch:list) -> list:
+        '''
+        Send a single request, read_area is used for a single range
+        '''
+        if len(batch) == 1:
+            read_range = batch[0]
+            # Positional, python-snap7 2.0 renamed dbnumber to db_number
+            return [plc_client.read_area(s7_areas[read_range.area], read_range.dbnumber, read_range.start, read_range.size)]
+        items = (snap7_types.S7DataItem * len(batch))()
+        buffers = []
+        for item, read_range in zip(items, batch):
+            buffer = ctypes.create_string_buffer(read_range.size)
+            item.Area = ctypes.c_int32(s7_areas[read_range.area].value)
+            item.WordLen = ctypes.c_int32(s7_byte_word_length)
+            item.Result = ctypes.c_int32(0)
+            item.DBNumber = ctypes.c_int32(read_range.dbnumber)
+            item.Start = ctypes.c_int32(read_range.start)
+            item.Amount = ctypes.c_int32(read_range.size)
+            item.pData = ctypes.cast(ctypes.pointer(buffer), ctypes.POINTER(ctypes.c_uint8))
+            buffers.append(buffer)
+        plc_client.read_multi_vars(items)
+        for item, read_range in zip(items, batch):
+            if item.Result != 0:
+                raise RuntimeError(f'Could not read {read_range}: {plc_client.error_text(item.Result)}')
+        return [buffer.raw for buffer in buffers]
+    
+    def execute(self, plc_client:snap7.client.Client) -> dict:
+        '''Read all the planned ranges.
+        
+        Parameters
+        ----------
+        plc_client : snap7.client.Client
+            Connected S7 protocol client.
+        
+        Returns
+        -------
+        dict
+            (area, dbnumber) -> bytearray image starting at the block start.
+        '''
+        
+        images = {key: bytearray(stop - start) for key, (start, stop) in self.blocks.items()}
+        for batch in self.batches:
+            for read_range, data in zip(batch, self.read_batch(plc_client, batch)):
+                key = (read_range.area, read_range.dbnumber)
+                position = read_range.start - self.blocks[key][0]
+                images[key][position:position + read_range.size] = data
+        return images
+
+
+class PollScheduler:
+    '''PollScheduler class\n
+    Fixed-rate scheduler with absolute deadlines on the monotonic clock.
+    The period does not drift with the read and decode time, overrun cycles
+    skip the missed slots instead of letting them pile up.
+    
+    Parameters
+    ----------
+    interval_s : float
+        Poll period in seconds.
+        
+    Attributes
+    ----------
+    interval_s : float
+        Poll period in seconds.
+    deadline : float or None
+        Monotonic time of the current slot.
+    started_at : float or None
+        Monotonic time of the first slot.
+    woke_at : float or None
+        Monotonic time of the last wake-up.
+    cycles : int
+        Number of started cycles.
+    overruns : int
+        Number of cycles which ran past the next deadline.
+    skipped : int
+        Number of slots skipped because of overruns.
+    '''
+    
+    def __init__(self, interval_s:float):
+        self.interval_s = interval_s
+        self.deadline = None
+        self.started_at = None
+        self.woke_at = None
+        self.cycles = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.jitter_sum_s = 0.0
+        self.jitter_square_sum_s = 0.0
+        self.jitter_max_s = 0.0
+        
+    def next_delay(self) -> float:
+        '''
+        Move to the next slot, return seconds left until its deadline
+        '''
+        now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = self.started_at = now
+            return 0.0
+        self.deadline += self.interval_s
+        if now > self.deadline:
+            missed = math.ceil((now - self.deadline)/self.interval_s)
+            self.overruns += 1
+            self.skipped += missed
+            self.deadline += missed*self.interval_s
+        return self.deadline - now
+    
+    def mark_wakeup(self):
+        '''
+        Account the wake-up of a cycle, jitter is the delay behind the deadline
+        '''
+        self.woke_at = time.monotonic()
+        jitter = self.woke_at - self.deadline
+        self.cycles += 1
+        self.jitter_sum_s += jitter
+        self.jitter_square_sum_s += jitter*jitter
+        self.jitter_max_s = max(self.jitter_max_s, jitter)
+        
+    def wait(self, stop_event:Event=None) -> bool:
+        '''
+        Sleep until the next slot, return True if the stop event was set
+        '''
+        delay = self.next_delay()
+        if stop_event is None:
+            time.sleep(delay)
+            stopped = False
+        else:
+            stopped = stop_event.wait(delay)
+        if not stopped:
+            self.mark_wakeup()
+        return stopped
+    
+    def stats(self) -> dict:
+        '''Get the scheduling statistics.
+        
+        Returns
+        -------
+        dict
+            cycles, overruns, skipped, jitter_mean_s, jitter_std_s, jitter_max_s,
+            target_rate_hz and achieved_rate_hz.
+        '''
+        
+        jitter_mean = self.jitter_sum_s/self.cycles if self.cycles else 0.0
+        jitter_var = self.jitter_square_sum_s/self.cycles - jitter_mean**2 if self.cycles else 0.0
+        elapsed = self.woke_at - self.started_at if self.cycles > 1 else 0.0
+        return {
+            'cycles'           : self.cycles,
+            'overruns'         : self.overruns,
+            'skipped'          : self.skipped,
+            'jitter_mean_s'    : jitter_mean,
+            'jitter_std_s'     : math.sqrt(max(jitter_var, 0.0)),
+            'jitter_max_s'     : self.jitter_max_s,
+            'target_rate_hz'   : 1/self.interval_s,
+            'achieved_rate_hz' : (self.cycles - 1)/elapsed if elapsed else 0.0,
+        }
+
+
+class SampleRing:
+    '''SampleRing class\n
+    Preallocated ring buffer history of decoded samples.
+    Every tag has its own NumPy column next to a timestamp column, tags of the
+    same type share a 2-D block so appending costs one assignment per type.
+    There is a single writer and no lock, readers get views of the columns.
+    
+    Parameters
+    ----------
+    names : list of str
+        Tag names in the layout order.
+    types : list of str
+        S7 data types in the layout order.
+    capacity : int
+        Number of samples kept.
+        
+    Attributes
+    ----------
+    names : list of str
+        Tag names in the layout order.
+    capacity : int
+        Number of samples kept.
+    seq : int
+        Sequence number of the next sample, also the number of samples written.
+    timestamps : np.ndarray
+        Wall-clock timestamp column in ns.
+    stamps : dict
+        ReadStamp field -> column in ns.
+    columns : dict
+        Tag name -> column, a view of the block of its type.
+    '''
+    
+    def __init__(self, names:list, types:list, capacity:int):
+        self.names = list(names)
+        self.capacity = capacity
+        self.seq = 0
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.stamps = {field: np.zeros(capacity, dtype=np.int64) for field in ReadStamp._fields}
+        self.groups = []
+        self.columns = {}
+        
+        type_slots = {}
+        for slot, data_type in enumerate(types):
+            dtype = s7_type(data_type).dtype
+            type_slots.setdefault(dtype, []).append(slot)
+        for dtype, slots in type_slots.items():
+            block = np.zeros((capacity, len(slots)), dtype=dtype)
+            self.groups.append((np.array(slots, dtype=np.intp), block))
+            for column, slot in enumerate(slots):
+                self.columns[self.names[slot]] = block[:, column]
+                
+    def append(self, values:np.ndarray, stamp:ReadStamp):
+        '''
+        Write a decoded sample, the sequence number is published after the data
+        '''
+        position = self.seq % self.capacity
+        for slots, block in self.groups:
+            block[position] = values[slots]
+        self.timestamps[position] = stamp.timestamp_ns
+        for field, value in zip(ReadStamp._fields, stamp):
+            self.stamps[field][position] = value
+        self.seq += 1
+        
+    def oldest_seq(self) -> int:
+        '''
+        Sequence number of the oldest sample still kept
+        '''
+        return max(self.seq - self.capacity, 0)
+    
+    def is_valid(self, seq:int) -> bool:
+        '''
+        True if the sample has not been overwritten yet, views read since seq are still intact
+        '''
+        return seq >= self.oldest_seq()
+    
+    def read_since(self, seq:int) -> RingRead:
+        '''Read all the samples written since a sequence number.
+        
+        Parameters
+        ----------
+        seq : int
+            Sequence number of the first sample of interest, e.g. stop_seq of the previous read.
+        
+        Returns
+        -------
+        RingRead
+            start_seq, stop_seq, number of dropped samples which were overwritten
+            before the read and up to two chunks (the ring may wrap around).
+            A chunk is a dict with timestamp_ns, ReadStamp field and tag name keys holding views.
+        '''
+        
+        stop_seq = self.seq
+        start_seq = max(seq, stop_seq - self.capacity)
+        dropped = max(start_seq - seq, 0)
+        chunks = []
+        position = start_seq
+        while position < stop_seq:
+            chunk_start = position % self.capacity
+            chunk_stop = min(chunk_start + stop_seq - position, self.capacity)
+            chunk = {'timestamp_ns': self.timestamps[chunk_start:chunk_stop]}
+            for field in ReadStamp._fields:
+                chunk[field] = self.stamps[field][chunk_start:chunk_stop]
+            for name in self.names:
+                chunk[name] = self.columns[name][chunk_start:chunk_stop]
+            chunks.append(chunk)
+            position += chunk_stop - chunk_start
+        return RingRead(start_seq, stop_seq, dropped, chunks)
+
+
+# Metrics recorded by the brokers: name -> (type, help)
+s7_metric_descriptions = {
+    's7_connect_seconds'        : ('histogram', 'Time to open the PLC session'),
+    's7_connect_failures_total' : ('counter', 'Failed connect and reconnect attempts'),
+    's7_read_seconds'           : ('histogram', 'Round trip of the read requests of a sample'),
+    's7_read_errors_total'      : ('counter', 'Failed reads'),
+    's7_decode_seconds'         : ('histogram', 'Decoding of an s7frame'),
+    's7_samples_total'          : ('counter', 'Decoded samples'),
+    's7_queue_put_seconds'      : ('histogram', 'Putting a message into the broker queue'),
+    's7_dropped_samples_total'  : ('counter', 'Messages dropped because the broker queue was full'),
+    's7_dequeue_age_seconds'    : ('histogram', 'Age of a sample when a consumer takes it from the queue'),
+    's7_published_payloads_total' : ('counter', 'Batched payloads delivered to the transport'),
+    's7_published_bytes_total'  : ('counter', 'Bytes of the delivered payloads'),
+    's7_publish_failures_total' : ('counter', 'Failed attempts to deliver a payload'),
+    's7_dropped_payloads_total' : ('counter', 'Payloads lost because the offline queue was full or missing'),
+    's7_sink_dropped_total'     : ('counter', 'Messages dropped because a sink queue or spill was full'),
+    's7_sink_spilled_total'     : ('counter', 'Messages spilled to disk by a sink'),
+    's7_sink_errors_total'      : ('counter', 'Messages a sink failed to handle'),
+}
+
+# Upper bounds of the latency histogram buckets in seconds
+s7_latency_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    '''Histogram class\n
+    Fixed-bucket histogram of durations, cheap enough to be updated on every cycle.
+    
+    Parameters
+    ----------
+    bounds : tuple of float
+        Sorted upper bounds of the buckets, an overflow bucket is added.
+        
+    Attributes
+    ----------
+    bounds : tuple of float
+        Upper bounds of the buckets.
+    counts : list of int
+        Observations per bucket, not cumulative, the last one is the overflow.
+    count : int
+        Number of observations.
+    sum : float
+        Sum of the observations.
+    min : float or None
+        Smallest observation.
+    max : float or None
+        Largest observation.
+    '''
+    
+    def __init__(self, bounds:tuple=s7_latency_buckets):
+        self.bounds = tuple(bounds)
+        self.counts = [0]*(len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        
+    def observe(self, value:float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        
+    def quantile(self, q:float) -> float:
+        '''
+        Estimate a quantile, linear within the bucket, the overflow bucket reports the max
+        '''
+        if self.count == 0:
+            return None
+        rank = q*self.count
+        cumulative = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                if bucket == len(self.bounds):
+                    return self.max
+                low = 0.0 if bucket == 0 else self.bounds[bucket - 1]
+                estimate = low + (self.bounds[bucket] - low)*(rank - cumulative)/bucket_count
+                return min(max(estimate, self.min), self.max)
+            cumulative += bucket_count
+        return self.max
+    
+    def to_dict(self) -> dict:
+        return {
+            'count' : self.count,
+            'sum'   : self.sum,
+            'min'   : self.min,
+            'max'   : self.max,
+            'p50'   : self.quantile(0.5),
+            'p99'   : self.quantile(0.99),
+        }
+
+
+def metric_labels(labels:dict) -> tuple:
+    '''
+    Key of the labels of a metric, values are kept as strings so a None label sorts with the others
+    '''
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def escape_label_value(value:str) -> str:
+    '''
+    Escape a label value for the Prometheus text exposition format
+    '''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    '''Metrics class\n
+    Thread-safe registry of counters and histograms labelled by PLC.
+    Brokers record every stage of a cycle into the shared s7_metrics registry,
+    collect() returns the values in-process and to_prometheus() renders them
+    in the Prometheus text format, see MetricsServer.
+    
+    Attributes
+    ----------
+    counters : dict
+        (name, labels) -> value, labels is a sorted tuple of (key, value) pairs, see metric_labels().
+    histograms : dict
+        (name, labels) -> Histogram.
+    lock : threading.Lock
+        Lock guarding the metrics.
+    '''
+    
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = Lock()
+        
+    def inc(self, name:str, value:float=1, **labels):
+        key = (name, metric_labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            
+    def observe(self, name:str, value:float, **labels):
+        key = (name, metric_labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+            
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            
+    def collect(self, **labels) -> dict:
+        '''Get the current values, optionally of the metrics having all the given labels.
+        
+        Returns
+        -------
+        dict
+            name -> list of (labels dict, value), histograms are summarized by Histogram.to_dict().
+        '''
+        
+        selected = set(metric_labels(labels))
+        collected = {}
+        with self.lock:
+            items = [(key, value) for key, value in self.counters.items()]
+            items += [(key, histogram.to_dict()) for key, histogram in self.histograms.items()]
+        for (name, key_labels), value in sorted(items, key=lambda item: item[0]):
+            if selected <= set(key_labels):
+                collected.setdefault(name, []).append((dict(key_labels), value))
+        return collected
+    
+    def to_prometheus(self) -> str:
+        '''
+        Render the metrics in the Prometheus text exposition format
+        '''
+        def render_labels(labels:tuple, *extra) -> str:
+            pairs = [f'{key}="{escape_label_value(value)}"' for key, value in labels + extra]
+            return '{' + ','.join(pairs) + '}' if pairs else ''
+        
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(histogram.counts), histogram.bounds, histogram.sum, histogram.count)
+                                for key, histogram in self.histograms.items())
+        lines = []
+        described = set()
+        def describe(name:str, kind:str):
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {name} {s7_metric_descriptions.get(name, (kind, name))[1]}')
+                lines.append(f'# TYPE {name} {kind}')
+                
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append(f'{name}{render_labels(labels)} {value}')
+        for (name, labels), counts, bounds, total, count in histograms:
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(bounds + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{render_labels(labels, ("le", le))} {cumulative}')
+            lines.append(f'{name}_sum{render_labels(labels)} {total}')
+            lines.append(f'{name}_count{render_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+# Registry shared by all the brokers of the process
+s7_metrics = Metrics()
+
+def observe_dequeue_age(metrics:Metrics, message, **labels):
+    '''
+    Record the age of a sample taken from a queue by a consumer, other messages are ignored
+    '''
+    if type(message) is Snapshot and not message.stamp is None:
+        age_s = (time.monotonic_ns() - message.stamp.response_monotonic_ns)/1e9
+        metrics.observe('s7_dequeue_age_seconds', age_s, **labels)
+
+
+class MetricsServer:
+    '''MetricsServer class\n
+    Optional HTTP endpoint serving a Metrics registry in the Prometheus text format
+    at /metrics, run by a daemon thread. Binds to localhost unless told otherwise.
+    
+    Parameters
+    ----------
+    metrics : Metrics
+        Registry to serve.
+    port : int
+        TCP port, 0 picks a free one.
+    host : str
+        Interface to bind.
+        
+    Attributes
+    ----------
+    metrics : Metrics
+        Registry to serve.
+    port : int
+        TCP port, the bound one once started.
+    host : str
+        Interface to bind.
+    server : http.server.ThreadingHTTPServer or None
+        Running server.
+    thread : threading.Thread or None
+        Thread serving the requests.
+    '''
+    
+    def __init__(self, metrics:Metrics=None, port:int=9108, host:str='127.0.0.1'):
+        self.metrics = s7_metrics if metrics is None else metrics
+        self.port = port
+        self.host = host
+        self.server = None
+        self.thread = None
+        
+    def start(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self.metrics
+        
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                
+            def log_message(self, format, *args):
+                pass
+            
+        self.server = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        self.port = self.server.server_address[1]
+        self.thread = Thread(target=self.server.serve_forever, name='MetricsServer', daemon=True)
+        self.thread.start()
+        print(f'Metrics> Serving http://{self.host}:{self.port}/metrics')
+        
+    def stop(self):
+        if not self.server is None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+
+class ReconnectPolicy:
+    '''ReconnectPolicy class\n
+    Exponential backoff with jitter and a circuit breaker for reconnecting to a PLC.
+    The delays are randomized, so brokers losing the network at the same moment
+    do not reconnect all at once. After breaker_threshold failed attempts the
+    circuit opens and the PLC is tried only once per breaker_cooldown_s.
+    
+    Parameters
+    ----------
+    base_delay_s : float
+        Delay before the first attempt in seconds.
+    max_delay_s : float
+        Upper bound of the exponential delay in seconds.
+    multiplier : float
+        Growth of the delay after every failed attempt.
+    jitter : float
+        Randomized part of the delay from 0 to 1, 1 draws the delay from [0, delay].
+    max_attempts : int or None
+        Failed attempts after which the broker gives up, None retries forever.
+        The breaker only opens when it is larger than breaker_threshold.
+    breaker_threshold : int or None
+        Failed attempts opening the circuit, None disables the breaker.
+    breaker_cooldown_s : float
+        Delay between the attempts while the circuit is open, jitter spreads it up to 1.5 times.
+        
+    Attributes
+    ----------
+    attempts : int
+        Failed attempts since the last success.
+    next_attempt_at : float or None
+        Monotonic time of the next attempt, None while connected.
+    '''
+    
+    def __init__(self, base_delay_s:float=1.0, max_delay_s:float=60.0, multiplier:float=2.0, jitter:float=1.0,
+                 max_attempts:int=3, breaker_threshold:int=10, breaker_cooldown_s:float=300.0):
+        assert 0 <= jitter <= 1
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown_s = breaker_cooldown_s
+        self.attempts = 0
+        self.next_attempt_at = None
+        
+    @property
+    def state(self) -> str:
+        '''
+        Circuit breaker state: closed, open or half-open once the cooldown has passed
+        '''
+        if self.breaker_threshold is None or self.attempts < self.breaker_threshold:
+            return 'closed'
+        return 'open' if self.remaining_s() > 0 else 'half-open'
+        
+    def backoff_s(self) -> float:
+        '''
+        Randomized delay before the next attempt
+        '''
+        if not self.breaker_threshold is None and self.attempts >= self.breaker_threshold:
+            # An open circuit waits at least the cooldown
+            return self.breaker_cooldown_s*(1 + 0.5*self.jitter*random.random())
+        delay = min(self.max_delay_s, self.base_delay_s*self.multiplier**self.attempts)
+        return delay*(1 - self.jitter*random.random())
+    
+    def schedule(self, now:float=None):
+        '''
+        Schedule the next attempt, called once the connection is lost and after every failure
+        '''
+        now = time.monotonic() if now is None else now
+        self.next_attempt_at = now + self.backoff_s()
+        
+    def record_failure(self, now:float=None):
+        self.attempts += 1
+        self.schedule(now)
+        
+    def record_success(self):
+        self.attempts = 0
+        self.next_attempt_at = None
+        
+    def remaining_s(self, now:float=None) -> float:
+        '''
+        Time left until the next attempt
+        '''
+        if self.next_attempt_at is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.next_attempt_at - now)
+    
+    def exhausted(self) -> bool:
+        '''
+        True if the broker should give up
+        '''
+        return not self.max_attempts is None and self.attempts >= self.max_attempts
+
+
+class S7Connection:
+    '''S7Connection class\n
+    A single S7 session shared by every broker reading the same PLC.
+    snap7 clients are not thread-safe, requests are serialized by a lock
+    and a broken session is reopened by the first broker needing it.
+    
+    Parameters
+    ----------
+    plc_ip : str
+        Plc's ip.
+    rack : int
+        Rack of the CPU.
+    slot : int
+        Slot of the CPU.
+    tcpport : int
+        ISO-on-TCP port.
+    health_check_s : float
+        Idle time in seconds after which the session is probed by health_check().
+        
+    Attributes
+    ----------
+    key : tuple
+        (plc_ip, rack, slot, tcpport) of the session.
+    health_check_s : float
+        Idle time in seconds after which the session is probed.
+    client : snap7.client.Client
+        S7 protocol client.
+    lock : threading.RLock
+        Lock serializing the requests.
+    users : int
+        Number of brokers holding the connection.
+    pdu_size : int or None
+        PDU size negotiated on the last connect.
+    last_ok : float or None
+        Monotonic time of the last successful request.
+    connects : int
+        Number of sessions opened.
+    '''
+    
+    def __init__(self, plc_ip:str, rack:int=0, slot:int=1, tcpport:int=102, health_check_s:float=10.0):
+        self.key = (plc_ip, rack, slot, tcpport)
+        self.health_check_s = health_check_s
+        self.client = snap7.client.Client()
+        self.lock = RLock()
+        self.users = 0
+        self.pdu_size = None
+        self.last_ok = None
+        self.connects = 0
+        
+    def get_connected(self) -> bool:
+        with self.lock:
+            return self.client.get_connected()
+        
+    def connect(self) -> int:
+        '''
+        Open the session unless it is already open, return the negotiated PDU size
+        '''
+        with self.lock:
+            if not self.client.get_connected():
+                plc_ip, rack, slot, tcpport = self.key
+                self.client.connect(plc_ip, rack, slot, tcpport)
+                self.pdu_size = self.client.get_pdu_length()
+                self.last_ok = time.monotonic()
+                self.connects += 1
+            return self.pdu_size
+        
+    def disconnect(self):
+        with self.lock:
+            self.client.disconnect()
+            
+    def execute(self, read_planner) -> tuple:
+        '''
+        Execute a read plan within the session, see ReadPlanner.execute().
+        Return the images and the ReadStamp taken around the requests, waiting for the lock excluded
+        '''
+        with self.lock:
+            request_ns, request_monotonic_ns = time.time_ns(), time.monotonic_ns()
+            images = read_planner.execute(self.client)
+            response_ns, response_monotonic_ns = time.time_ns(), time.monotonic_ns()
+            self.last_ok = response_monotonic_ns/1e9
+            return images, ReadStamp(request_ns, response_ns, request_monotonic_ns, response_monotonic_ns)
+        
+    def health_check(self, force:bool=False) -> bool:
+        '''
+        Probe an idle session with a CPU state request, a dead session is closed.
+        Return True if the session is open.
+        '''
+        with self.lock:
+            if not self.client.get_connected():
+                return False
+            if not force and not self.last_ok is None and time.monotonic() - self.last_ok < self.health_check_s:
+                return True
+            try:
+                self.client.get_cpu_state()
+            except s7_errors:
+                self.client.disconnect()
+                return False
+            self.last_ok = time.monotonic()
+            return True
+
+
+class ConnectionPool:
+    '''ConnectionPool class\n
+    Process-wide pool of S7 sessions, brokers reading the same CPU share one
+    session instead of using up its connection resources. Sessions are closed
+    when their last broker releases them.
+    
+    Parameters
+    ----------
+    health_check_s : float
+        Idle time in seconds after which a session is probed, see S7Connection.
+        
+    Attributes
+    ----------
+    health_check_s : float
+        Idle time in seconds after which a session is probed.
+    connections : dict
+        (plc_ip, rack, slot, tcpport) -> S7Connection.
+    lock : threading.Lock
+        Lock guarding the connections.
+    monitor : threading.Thread or None
+        Thread running the periodic health checks.
+    monitor_stop_event : threading.Event
+        Event to stop the monitor.
+    '''
+    
+    def __init__(self, health_check_s:float=10.0):
+        self.health_check_s = health_check_s
+        self.connections = {}
+        self.lock = Lock()
+        self.monitor = None
+        self.monitor_stop_event = Event()
+        
+    def acquire(self, plc_ip:str, rack:int=0, slot:int=1, tcpport:int=102) -> S7Connection:
+        '''
+        Get the shared connection of a PLC, it is opened by S7Connection.connect()
+        '''
+        key = (plc_ip, rack, slot, tcpport)
+        with self.lock:
+            connection = self.connections.get(key)
+            if connection is None:
+                connection = S7Connection(plc_ip, rack, slot, tcpport, self.health_check_s)
+                self.connections[key] = connection
+            connection.users += 1
+            return connection
+        
+    def release(self, connection:S7Connection):
+        '''
+        Give the connection back, the last user closes the session
+        '''
+        with self.lock:
+            connection.users -= 1
+            if connection.users > 0:
+                return
+            if self.connections.get(connection.key) is connection:
+                del self.connections[connection.key]
+        connection.disconnect()
+        
+    def health_check(self) -> dict:
+        '''
+        Probe the idle sessions, return (plc_ip, rack, slot, tcpport) -> True if open
+        '''
+        with self.lock:
+            connections = list(self.connections.values())
+        return {connection.key: connection.health_check() for connection in connections}
+    
+    def start_monitor(self, interval_s:float=None):
+        '''
+        Run the health checks periodically in a daemon thread
+        '''
+        interval_s = self.health_check_s if interval_s is None else interval_s
+        if not self.monitor is None and self.monitor.is_alive():
+            return
+        self.monitor_stop_event.clear()
+        
+        def monitor():
+            while not self.monitor_stop_event.wait(interval_s):
+                self.health_check()
+                
+        self.monitor = Thread(target=monitor, name='ConnectionPool', daemon=True)
+        self.monitor.start()
+        
+    def stop_monitor(self):
+        self.monitor_stop_event.set()
+        if not self.monitor is None:
+            self.monitor.join()
+            self.monitor = None
+
+
+# Pool shared by all the brokers of the process
+s7_connection_pool = ConnectionPool()
+
+
+def batch_document(snapshots:list, source:str=None, delta:bool=True) -> dict:
+    '''Build the column-oriented document of a batch of samples.
+    
+    Parameters
+    ----------
+    snapshots : list of Snapshot
+        Samples of one broker, oldest first.
+    source : str or None
+        Name of the publishing broker.
+    delta : bool
+        True stores the sequence numbers, the timestamps and the integer columns
+        as the first value followed by the differences, which are small numbers
+        for slowly changing process values.
+    
+    Returns
+    -------
+    dict
+        v, source, count, names, seq, timestamp_ns, read_ns, values (one list per tag)
+        and delta (slots of the delta-encoded value columns, None when delta is off).
+    '''
+    
+    def encode_column(column:np.ndarray) -> list:
+        if column.dtype.kind in 'iu' and delta:
+            column = column.astype(np.int64)
+            return np.diff(column, prepend=0).tolist()
+        if column.dtype.kind in 'biuf':
+            return column.tolist()
+        return [str(value) for value in column]
+    
+    rows = np.array([snapshot.values for snapshot in snapshots], dtype=object).reshape(len(snapshots), -1)
+    columns = [np.array(rows[:, slot].tolist()) for slot in range(rows.shape[1])]
+    stamps = [snapshot.stamp for snapshot in snapshots]
+    document = {
+        'v'            : 1,
+        'source'       : source,
+        'count'        : len(snapshots),
+        'names'        : list(snapshots[0].names) if snapshots else [],
+        'seq'          : encode_column(np.array([-1 if snapshot.seq is None else snapshot.seq for snapshot in snapshots], dtype=np.int64)),
+        'timestamp_ns' : encode_column(np.array([snapshot.timestamp_ns or 0 for snapshot in snapshots], dtype=np.int64)),
+        'read_ns'      : None if None in stamps else [stamp.read_ns for stamp in stamps],
+        'values'       : [encode_column(column) for column in columns],
+        'delta'        : [slot for slot, column in enumerate(columns) if column.dtype.kind in 'iu'] if delta else None,
+    }
+    return document
+
+def restore_batch(document:dict) -> dict:
+    '''
+    Undo the delta encoding of a batch document, see batch_document()
+    '''
+    if document['delta'] is None:
+        return document
+    document = dict(document)
+    document['seq'] = np.cumsum(document['seq']).tolist()
+    document['timestamp_ns'] = np.cumsum(document['timestamp_ns']).tolist()
+    values = list(document['values'])
+    for slot in document['delta']:
+        values[slot] = np.cumsum(values[slot]).tolist()
+    document['values'] = values
+    document['delta'] = None
+    return document
+
+def encode_payload(document:dict, encoding:str='json', compression:str='zlib') -> bytes:
+    '''Serialize and compress a document.
+    
+    Parameters
+    ----------
+    document : dict
+        Document made of plain Python values.
+    encoding : str
+        'json', 'msgpack' (needs the msgpack package) or 'cbor' (needs the cbor2 package).
+    compression : str or None
+        'zlib', 'zstd' (needs the zstandard package) or None.
+    
+    Returns
+    -------
+    bytes
+        Payload of a message.
+    '''
+    
+    if encoding == 'json':
+        payload = json.dumps(document, separators=(',', ':'), default=str).encode()
+    elif encoding == 'msgpack':
+        import msgpack
+        payload = msgpack.packb(document, default=str)
+    elif encoding == 'cbor':
+        import cbor2
+        payload = cbor2.dumps(document, default=lambda encoder, value: encoder.encode(str(value)))
+    else:
+        raise ValueError(f'Unknown payload encoding: {encoding}')
+    if compression is None:
+        return payload
+    if compression == 'zlib':
+        import zlib
+        return zlib.compress(payload, 6)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compress(payload)
+    raise ValueError(f'Unknown payload compression: {compression}')
+
+def decode_payload(payload:bytes, encoding:str='json', compression:str='zlib') -> dict:
+    '''
+    Decompress and deserialize a payload made by encode_payload()
+    '''
+    if compression == 'zlib':
+        import zlib
+        payload = zlib.decompress(payload)
+    elif compression == 'zstd':
+        import zstandard
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    elif not compression is None:
+        raise ValueError(f'Unknown payload compression: {compression}')
+    if encoding == 'json':
+        return json.loads(payload)
+    if encoding == 'msgpack':
+        import msgpack
+        return msgpack.unpackb(payload)
+    if encoding == 'cbor':
+        import cbor2
+        return cbor2.loads(payload)
+    raise ValueError(f'Unknown payload encoding: {encoding}')
+
+
+class OfflineQueue:
+    '''OfflineQueue class\n
+    Bounded FIFO of payloads on disk, one file per payload, which keeps the
+    unsent messages across link outages and restarts. The oldest payloads are
+    dropped when the bounds are reached.
+    
+    Parameters
+    ----------
+    path : str
+        Directory of the queue, created if missing.
+    max_bytes : int
+        Largest total size of the queued payloads.
+    max_items : int or None
+        Largest number of queued payloads, None for no limit.
+    
+    Attributes
+    ----------
+    path : str
+        Directory of the queue.
+    max_bytes : int
+        Largest total size of the queued payloads.
+    max_items : int or None
+        Largest number of queued payloads.
+    entries : list of tuple
+        (file name, size) of the queued payloads, oldest first.
+    size_bytes : int
+        Total size of the queued payloads.
+    dropped : int
+        Number of payloads dropped because of the bounds.
+    '''
+    
+    def __init__(self, path:str, max_bytes:int=64*1024*1024, max_items:int=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.lock = Lock()
+        self.dropped = 0
+        os.makedirs(path, exist_ok=True)
+        # Other files in the directory are not payloads of the queue and are left alone
+        names = sorted((name for name in os.listdir(path) if name.endswith('.bin') and name[:-4].isdecimal()),
+                       key=lambda name: int(name[:-4]))
+        self.entries = [(name, os.path.getsize(os.path.join(path, name))) for name in names]
+        self.size_bytes = sum(size for _, size in self.entries)
+        self.next_index = int(names[-1][:-4]) + 1 if names else 0
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def put(self, payload:bytes) -> int:
+        '''
+        Queue a payload, return the number of dropped old payloads
+        '''
+        with self.lock:
+            name = f'{self.next_index:012d}.bin'
+            self.next_index += 1
+            file_path = os.path.join(self.path, name)
+            # Written aside and renamed, a crash never leaves a truncated payload in the queue
+            with open(file_path + '.tmp', 'wb') as payload_file:
+                payload_file.write(payload)
+            os.replace(file_path + '.tmp', file_path)
+            self.entries.append((name, len(payload)))
+            self.size_bytes += len(payload)
+            dropped = 0
+            while len(self.entries) > 1 and (self.size_bytes > self.max_bytes or
+                                             (not self.max_items is None and len(self.entries) > self.max_items)):
+                self.remove_oldest()
+                dropped += 1
+            self.dropped += dropped
+            return dropped
+    
+    def peek(self) -> bytes:
+        '''
+        Get the oldest payload without removing it, None if the queue is empty
+        '''
+        with self.lock:
+            if not self.entries:
+                return None
+            with open(os.path.join(self.path, self.entries[0][0]), 'rb') as payload_file:
+                return payload_file.read()
+    
+    def pop(self):
+        '''
+        Remove the oldest payload, once it is sent
+        '''
+        with self.lock:
+            if self.entries:
+                self.remove_oldest()
+    
+    def remove_oldest(self):
+        name, size = self.entries.pop(0)
+        self.size_bytes -= size
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+
+class BatchPublisher:
+    '''BatchPublisher class\n
+    Groups samples into one compressed payload per max_samples samples or
+    max_delay_s seconds, whichever comes first, and hands it to a transport.
+    Payloads the transport fails to send go to an optional OfflineQueue and are
+    sent first, oldest first, once the link is back.
+    
+    Parameters
+    ----------
+    send : callable
+        Transport, send(payload) returns False or raises if the payload was not delivered.
+    max_samples : int
+        Samples per payload.
+    max_delay_s : float
+        Longest time a sample waits for its payload.
+    encoding : str
+        Payload encoding, see encode_payload().
+    compression : str or None
+        Payload compression, see encode_payload().
+    delta : bool
+        Delta-encode the integer columns, see batch_document().
+    offline_queue : OfflineQueue or None
+        Spool of the undelivered payloads, None drops them.
+    retry_s : float
+        Least time between two attempts to send the spooled payloads.
+    source : str or None
+        Name of the publishing broker, written into the payloads.
+    metrics : Metrics or None
+        Registry of the publish counters, the shared one by default.
+    
+    Attributes
+    ----------
+    pending : list of Snapshot
+        Samples of the next payload.
+    deadline : float or None
+        Monotonic time when the pending samples have to be sent.
+    '''
+    
+    def __init__(self, send, max_samples:int=100, max_delay_s:float=1.0, encoding:str='json', compression:str='zlib',
+                 delta:bool=True, offline_queue:OfflineQueue=None, retry_s:float=5.0, source:str=None, metrics:'Metrics'=None):
+        assert max_samples > 0, 'Batch must hold at least one sample'
+        self.send = send
+        self.max_samples = max_samples
+        self.max_delay_s = max_delay_s
+        self.encoding = encoding
+        self.compression = compression
+        self.delta = delta
+        self.offline_queue = offline_queue
+        self.retry_s = retry_s
+        self.source = source
+        self.metrics = s7_metrics if metrics is None else metrics
+        self.pending = []
+        self.deadline = None
+        self.retry_at = 0.0
+    
+    def add(self, snapshot:'Snapshot'):
+        '''
+        Add a sample, the batch is published once full
+        '''
+        if not self.pending:
+            self.deadline = time.monotonic() + self.max_delay_s
+        self.pending.append(snapshot)
+        if len(self.pending) >= self.max_samples:
+            self.flush()
+    
+    def wait_s(self, idle_s:float=None) -> float:
+        '''
+        Seconds until the pending samples are due or the spooled payloads are retried, idle_s if neither
+        '''
+        deadlines = [] if self.deadline is None else [self.deadline]
+        if self.offline_queue:
+            deadlines.append(self.retry_at)
+        if not deadlines:
+            return idle_s
+        return max(0.0, min(deadlines) - time.monotonic())
+    
+    def poll(self):
+        '''
+        Publish the pending samples if they are due, retry the spooled payloads
+        '''
+        if not self.deadline is None and time.monotonic() >= self.deadline:
+            self.flush()
+        elif self.offline_queue and time.monotonic() >= self.retry_at:
+            self.drain()
+    
+    def flush(self):
+        '''
+        Publish the pending samples now
+        '''
+        if not self.pending:
+            return
+        document = batch_document(self.pending, self.source, self.delta)
+        self.pending = []
+        self.deadline = None
+        payload = encode_payload(document, self.encoding, self.compression)
+        # Wait with the new payload while the link is known to be down or older payloads are still spooled
+        if not self.offline_queue is None and (time.monotonic() < self.retry_at or not self.drain()):
+            self.spool(payload)
+        elif not self.deliver(payload):
+            self.spool(payload)
+    
+    def deliver(self, payload:bytes) -> bool:
+        try:
+            delivered = self.send(payload) is not False
+        except Exception as error:
+            print(f'Publisher> Cant send payload: {error}')
+            delivered = False
+        if delivered:
+            self.metrics.inc('s7_published_payloads_total', plc=self.source)
+            self.metrics.inc('s7_published_bytes_total', len(payload), plc=self.source)
+        else:
+            self.metrics.inc('s7_publish_failures_total', plc=self.source)
+            self.retry_at = time.monotonic() + self.retry_s
+        return delivered
+    
+    def spool(self, payload:bytes):
+        if self.offline_queue is None:
+            self.metrics.inc('s7_dropped_payloads_total', plc=self.source)
+            return
+        dropped = self.offline_queue.put(payload)
+        if dropped:
+            self.metrics.inc('s7_dropped_payloads_total', dropped, plc=self.source)
+    
+    def drain(self) -> bool:
+        '''
+        Send the spooled payloads oldest first, return True once the spool is empty
+        '''
+        while self.offline_queue:
+            payload = self.offline_queue.peek()
+            if not self.deliver(payload):
+                return False
+            self.offline_queue.pop()
+        return True
+
+
+def json_default(value):
+    '''
+    Convert the NumPy scalars of the decoded values for json.dumps(), other values become strings
+    '''
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+# Backpressure policies of the sinks
+sink_policies = ('drop_oldest', 'block', 'spill')
+
+# Longest wait for a sink to handle its queued messages once its broker ends
+sink_join_timeout_s = 10.0
+
+class Sink:
+    '''Sink class\n
+    Consumer of the broker messages with its own bounded queue and worker thread,
+    a slow sink neither stalls the broker nor the other sinks. All the sinks get
+    the same immutable Snapshot by reference. Subclasses override handle() and
+    optionally open() and close(), run in the worker, and wait_s() and poll()
+    for time-driven work such as flushing batches.
+    
+    Parameters
+    ----------
+    name : str
+        Name of the sink, unique per broker.
+    maxsize : int
+        Capacity of the sink queue.
+    policy : str
+        Behaviour when the queue is full: 'drop_oldest' drops the oldest message,
+        'block' makes the broker wait up to block_timeout_s before dropping the new one,
+        'spill' pickles the messages to an OfflineQueue on disk until the sink catches up.
+    block_timeout_s : float
+        Longest wait of the broker with the 'block' policy.
+    spill_path : str or None
+        Directory of the spill, required with the 'spill' policy.
+    spill_max_bytes : int
+        Largest size of the spill, the oldest spilled messages are dropped beyond it.
+    
+    Attributes
+    ----------
+    queue : queue.Queue
+        Queue of the sink.
+    spill : OfflineQueue or None
+        Messages waiting on disk, oldest first.
+    worker : threading.Thread or None
+        Thread running the sink.
+    stop_event : threading.Event
+        Set once the sink has to end after its queued messages, the stop is never dropped.
+    source : str or None
+        Name of the broker feeding the sink.
+    types : list of str or None
+        Data types of the values in the layout order, set by the broker.
+    metrics : Metrics
+        Registry of the sink counters, labelled with sink=name.
+    '''
+    
+    def __init__(self, name:str, maxsize:int=100, policy:str='drop_oldest', block_timeout_s:float=1.0,
+                 spill_path:str=None, spill_max_bytes:int=64*1024*1024):
+        assert policy in sink_policies, f'Unknown sink policy: {policy}'
+        assert policy != 'spill' or not spill_path is None, 'Spill policy needs a spill path'
+        self.name = name
+        self.queue = Queue(maxsize)
+        self.policy = policy
+        self.block_timeout_s = block_timeout_s
+        self.spill = None if spill_path is None else OfflineQueue(spill_path, spill_max_bytes)
+        self.worker = None
+        self.stop_event = Event()
+        self.source = None
+        self.types = None
+        self.metrics = s7_metrics
+    
+    def start(self):
+        self.stop_event.clear()
+        self.worker = Thread(target=self.run, name=f'Sink-{self.name}', daemon=True)
+        self.worker.start()
+    
+    def stop(self, timeout:float=sink_join_timeout_s):
+        '''
+        Let the sink handle the queued messages and end its worker
+        '''
+        self.offer('kill consumer')
+        self.join(timeout)
+        
+    def join(self, timeout:float=sink_join_timeout_s) -> bool:
+        '''
+        Wait for the worker to end, return False if it is still busy after the timeout
+        '''
+        if not self.worker is None:
+            self.worker.join(timeout)
+            if self.worker.is_alive():
+                print(f'Sink> {self.name}: Still busy after {timeout} s, not joined')
+                return False
+        return True
+    
+    def offer(self, message):
+        '''
+        Hand a message over to the sink, called by the broker
+        '''
+        if type(message) is str and message == 'kill consumer':
+            # The worker ends once the queue and the spill are empty, the message only wakes it up
+            self.stop_event.set()
+            if not self.spill:
+                try:
+                    self.queue.put_nowait(message)
+                except Full:
+                    pass
+        elif self.policy == 'spill' and (self.spill or self.queue.full()):
+            # Once spilling, every message goes to disk until the spill is drained, the order is kept
+            import pickle
+            dropped = self.spill.put(pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+            self.metrics.inc('s7_sink_spilled_total', plc=self.source, sink=self.name)
+            if dropped:
+                self.metrics.inc('s7_sink_dropped_total', dropped, plc=self.source, sink=self.name)
+        elif self.policy == 'block':
+            try:
+                self.queue.put(message, timeout=self.block_timeout_s)
+            except Full:
+                self.metrics.inc('s7_sink_dropped_total', plc=self.source, sink=self.name)
+        else:
+            # Only the broker puts into the queue, after dropping the oldest message there is room
+            try:
+                self.queue.put_nowait(message)
+            except Full:
+                try:
+                    dropped = self.queue.get_nowait()
+                except Empty:
+                    # The worker took the oldest message meanwhile, nothing is dropped
+                    dropped = None
+                if type(dropped) is Snapshot and type(message) is Snapshot:
+                    message = message.absorb(dropped)
+                self.queue.put_nowait(message)
+                if not dropped is None:
+                    self.metrics.inc('s7_sink_dropped_total', plc=self.source, sink=self.name)
+    
+    def next_message(self):
+        '''
+        Take the next message, None if nothing came within wait_s(), 'kill consumer' once stopped and drained
+        '''
+        if self.spill:
+            try:
+                return self.queue.get_nowait()
+            except Empty:
+                import pickle
+                message = pickle.loads(self.spill.peek())
+                self.spill.pop()
+                return message
+        try:
+            if self.stop_event.is_set():
+                return self.queue.get_nowait()
+            return self.queue.get(timeout=self.wait_s())
+        except Empty:
+            return 'kill consumer' if self.stop_event.is_set() else None
+    
+    def run(self):
+        try:
+            self.open()
+            while True:
+                message = self.next_message()
+                if type(message) is str and message == 'kill consumer':
+                    break
+                observe_dequeue_age(self.metrics, message, plc=self.source, sink=self.name)
+                try:
+                    if message is None:
+                        self.poll()
+                    else:
+                        self.handle(message)
+                except Exception as error:
+                    self.metrics.inc('s7_sink_errors_total', plc=self.source, sink=self.name)
+                    print(f'Sink> {self.name}: Cant handle message: {error}')
+        finally:
+            self.close()
+    
+    def open(self):
+        pass
+    
+    def close(self):
+        pass
+    
+    def wait_s(self) -> float:
+        '''
+        Seconds to wait for a message before poll() is called, None waits forever
+        '''
+        return None
+    
+    def poll(self):
+        pass
+    
+    def handle(self, snapshot:'Snapshot'):
+        pass
+    
+    
+class CallbackSink(Sink):
+    '''CallbackSink class\n
+    Calls callback(snapshot) for every sample in the worker of the sink.
+    '''
+    
+    def __init__(self, callback, name:str='callback', **options):
+        super().__init__(name, **options)
+        self.callback = callback
+    
+    def handle(self, snapshot:'Snapshot'):
+        self.callback(snapshot)
+        
+        
+class ConsoleSink(Sink):
+    '''ConsoleSink class\n
+    Prints the sequence number and the values of every sample, all the tags or the given ones.
+    '''
+    
+    def __init__(self, tags:list=None, name:str='console', **options):
+        super().__init__(name, **options)
+        self.tags = tags
+    
+    def handle(self, snapshot:'Snapshot'):
+        tags = snapshot.names if self.tags is None else self.tags
+        values = ', '.join(f'{tag}={snapshot[tag]}' for tag in tags)
+        print(f'{self.source}> #{snapshot.seq} {values}')
+        
+        
+class FileSink(Sink):
+    '''FileSink class\n
+    Appends every sample to a file as a line of JSON with the header and the values.
+    '''
+    
+    def __init__(self, path:str, name:str='file', **options):
+        super().__init__(name, **options)
+        self.path = path
+        self.file = None
+    
+    def open(self):
+        self.file = open(self.path, 'a')
+    
+    def close(self):
+        if not self.file is None:
+            self.file.close()
+    
+    def handle(self, snapshot:'Snapshot'):
+        self.file.write(json.dumps({**snapshot.header(), 'values': snapshot.to_dict()}, default=json_default) + '\n')
+        
+        
+class MqttSink(Sink):
+    '''MqttSink class\n
+    Publishes batched payloads through a BatchPublisher, send is the transport,
+    e.g. lambda payload: client.publish(topic, payload, qos=1) of an MQTT client.
+    publisher_options are the parameters of BatchPublisher.
+    '''
+    
+    def __init__(self, send, name:str='mqtt', maxsize:int=1000, policy:str='drop_oldest', block_timeout_s:float=1.0,
+                 spill_path:str=None, spill_max_bytes:int=64*1024*1024, **publisher_options):
+        super().__init__(name, maxsize, policy, block_timeout_s, spill_path, spill_max_bytes)
+        self.send = send
+        self.publisher_options = publisher_options
+        self.publisher = None
+    
+    def open(self):
+        self.publisher = BatchPublisher(self.send, source=self.source, metrics=self.metrics, **self.publisher_options)
+    
+    def close(self):
+        if not self.publisher is None:
+            self.publisher.flush()
+    
+    def wait_s(self) -> float:
+        return self.publisher.wait_s()
+    
+    def poll(self):
+        self.publisher.poll()
+    
+    def handle(self, snapshot:'Snapshot'):
+        self.publisher.add(snapshot)
+        
+        
+class DatabaseSink(Sink):
+    '''DatabaseSink class\n
+    Inserts the numeric values of every sample as (timestamp_ns, seq, name, value) rows
+    through a DB-API connection with qmark parameters (sqlite3, duckdb). Rows are
+    committed every batch_size samples or commit_interval_s seconds.
+    
+    Parameters
+    ----------
+    connect : callable
+        Opens the connection, called in the worker of the sink.
+    table : str
+        Table of the rows, created if missing.
+    batch_size : int
+        Samples per transaction.
+    commit_interval_s : float
+        Longest time a sample waits for its transaction, also the retry delay after a failed one.
+    max_pending : int or None
+        Most samples kept while the transactions fail, the oldest are dropped beyond it,
+        10 batches by default.
+    '''
+    
+    def __init__(self, connect, table:str='samples', batch_size:int=100, commit_interval_s:float=1.0,
+                 name:str='database', max_pending:int=None, **options):
+        super().__init__(name, **options)
+        self.connect = connect
+        self.table = table
+        self.batch_size = batch_size
+        self.commit_interval_s = commit_interval_s
+        self.max_pending = 10*batch_size if max_pending is None else max_pending
+        self.connection = None
+        self.rows = []
+        self.pending = 0
+        self.deadline = None
+        self.retry_at = 0.0
+        self.slots = None
+    
+    def open(self):
+        self.connection = self.connect()
+        self.create_tables()
+        
+    def create_tables(self):
+        self.connection.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.table} (timestamp_ns BIGINT, seq BIGINT, name VARCHAR, value DOUBLE)'
+            )
+    
+    def close(self):
+        if not self.connection is None:
+            self.commit()
+            self.connection.close()
+    
+    def wait_s(self) -> float:
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+    
+    def poll(self):
+        self.commit()
+    
+    def handle(self, snapshot:'Snapshot'):
+        if self.slots is None:
+            self.slots = [slot for slot, value in enumerate(snapshot.values) if np.asarray(value).dtype.kind in 'biuf']
+        self.rows.extend((snapshot.timestamp_ns, snapshot.seq, snapshot.names[slot], float(snapshot.values[slot]))
+                         for slot in self.slots)
+        self.pending += 1
+        if self.pending > self.max_pending:
+            # Rows come in blocks of the same tags, one block per sample
+            del self.rows[:len(self.slots)]
+            self.pending -= 1
+            self.metrics.inc('s7_sink_dropped_total', plc=self.source, sink=self.name)
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.commit_interval_s
+        if self.pending >= self.batch_size and time.monotonic() >= self.retry_at:
+            self.commit()
+    
+    def commit(self):
+        '''
+        Insert the buffered rows in a single transaction, keep them for a retry if it fails
+        '''
+        if self.rows:
+            try:
+                self.connection.execute('BEGIN')
+                self.insert(self.rows)
+                self.connection.commit()
+            except Exception as error:
+                self.rollback()
+                self.metrics.inc('s7_sink_errors_total', plc=self.source, sink=self.name)
+                print(f'Sink> {self.name}: Cant commit {self.pending} samples: {error}')
+                self.retry_at = self.deadline = time.monotonic() + self.commit_interval_s
+                return
+        self.rows = []
+        self.pending = 0
+        self.deadline = None
+        self.retry_at = 0.0
+        
+    def rollback(self):
+        try:
+            self.connection.rollback()
+        except Exception:
+            # No transaction is open if BEGIN itself failed
+            pass
+        
+    def insert(self, rows:list):
+        self.connection.executemany(f'INSERT INTO {self.table} VALUES (?, ?, ?, ?)', rows)
 
-def frombuffer(buffer:bytearray, type:str):
-    '''Transform bytes to a value depending on the type.\n
-    S7 family defines big-endian coding.
+
+# Rollup tables of the historian: table -> bucket width in ns
+historian_rollups = {
+    'rollup_1s' : 1_000_000_000,
+    'rollup_1m' : 60_000_000_000,
+    'rollup_1h' : 3_600_000_000_000,
+}
+
+# Rows per INSERT statement of the historian, within the 32766 parameters of SQLite
+historian_rows_per_statement = 500
+
+class HistorianSink(DatabaseSink):
+    '''HistorianSink class\n
+    Local historian in SQLite (WAL mode) or DuckDB, queryable while the cloud link is down.
+    The raw rows go to the samples table and every flush updates the rollup tables
+    (count, min, max, sum and avg per bucket and tag) in the same transaction,
+    dashboards query the rollups instead of the raw rows.
     
     Parameters
     ----------
-    buffer : bytearray
-        Bytes to be transformed into a value.
-    type : str
-        Type of the value.
-    
-    Returns
-    -------
-    float
-        If the type was defined as a Real. Real refers to s7 family.
-    int
-        If the type was defines as an Int.
-    None
-        If the type differs from the ones above.
+    path : str
+        Path of the database file.
+    engine : str
+        'sqlite' or 'duckdb' (needs the duckdb package).
+    rollups : dict
+        Rollup table -> bucket width in ns, see historian_rollups.
+    batch_size : int
+        Samples per transaction.
+    commit_interval_s : float
+        Longest time a sample waits for its transaction.
     '''
     
-    value = None
-    if type=='Int':
-        value = np.frombuffer(buffer, dtype='>i2')
-    elif type=='Real':
-        value = np.frombuffer(buffer, dtype='>f')
-    return value[0] if not value is None else None
+    def __init__(self, path:str, engine:str='sqlite', rollups:dict=historian_rollups, batch_size:int=100,
+                 commit_interval_s:float=1.0, name:str='historian', **options):
+        assert engine in ('sqlite', 'duckdb'), f'Unknown historian engine: {engine}'
+        super().__init__(self.open_database, 'samples', batch_size, commit_interval_s, name, **options)
+        self.path = path
+        self.engine = engine
+        self.rollups = rollups
+    
+    def open_database(self):
+        if self.engine == 'duckdb':
+            import duckdb
+            return duckdb.connect(self.path)
+        import sqlite3
+        connection = sqlite3.connect(self.path)
+        # Dashboards read while the sink writes, NORMAL sync is safe against corruption in WAL mode
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+    
+    def create_tables(self):
+        super().create_tables()
+        self.connection.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_name_time ON {self.table} (name, timestamp_ns)')
+        for table in self.rollups:
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} (bucket_ns BIGINT, name VARCHAR, value_count BIGINT, value_min DOUBLE, '
+                'value_max DOUBLE, value_sum DOUBLE, value_avg DOUBLE, PRIMARY KEY (bucket_ns, name))'
+                )
+    
+    def execute_rows(self, statement:str, rows:list, suffix:str=''):
+        '''
+        Run an INSERT statement with many rows per VALUES clause, DuckDB is slow with executemany
+        '''
+        placeholders = '(' + ', '.join(['?']*len(rows[0])) + ')'
+        for start in range(0, len(rows), historian_rows_per_statement):
+            chunk = rows[start:start + historian_rows_per_statement]
+            self.connection.execute(f'{statement} VALUES {", ".join([placeholders]*len(chunk))}{suffix}',
+                                    [value for row in chunk for value in row])
+            
+    def insert(self, rows:list):
+        self.execute_rows(f'INSERT INTO {self.table}', rows)
+        # Rows come in blocks of the same tags, one block per sample
+        tag_count = len(self.slots)
+        names = [name for _, _, name, _ in rows[:tag_count]]
+        timestamps = np.array([timestamp_ns for timestamp_ns, _, _, _ in rows[::tag_count]], dtype=np.int64)
+        values = np.array([value for _, _, _, value in rows], dtype=np.float64).reshape(-1, tag_count)
+        for table, width_ns in self.rollups.items():
+            self.execute_rows(
+                f'INSERT INTO {table}',
+                self.aggregate(timestamps, values, names, width_ns),
+                ' ON CONFLICT (bucket_ns, name) DO UPDATE SET '
+                f'value_count = {table}.value_count + excluded.value_count, '
+                f'value_min = CASE WHEN excluded.value_min < {table}.value_min THEN excluded.value_min ELSE {table}.value_min END, '
+                f'value_max = CASE WHEN excluded.value_max > {table}.value_max THEN excluded.value_max ELSE {table}.value_max END, '
+                f'value_sum = {table}.value_sum + excluded.value_sum, '
+                f'value_avg = ({table}.value_sum + excluded.value_sum)/({table}.value_count + excluded.value_count)'
+                )
+    
+    def aggregate(self, timestamps:np.ndarray, values:np.ndarray, names:list, width_ns:int) -> list:
+        '''
+        Rollup rows (bucket_ns, name, count, min, max, sum, avg) of the samples in buckets of width_ns.
+        NaN values are left out, a tag without any other value in a bucket gets no row
+        '''
+        buckets = timestamps//width_ns*width_ns
+        order = np.argsort(buckets, kind='stable')
+        buckets, values = buckets[order], values[order]
+        starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+        # sqlite3 stores NaN as NULL, which would stick to the upserted aggregates of the bucket
+        valid = ~np.isnan(values)
+        counts = np.add.reduceat(valid.astype(np.int64), starts)
+        minimum = np.fmin.reduceat(values, starts)
+        maximum = np.fmax.reduceat(values, starts)
+        total = np.add.reduceat(np.where(valid, values, 0.0), starts)
+        return [(int(buckets[start]), name, int(counts[row, column]), float(minimum[row, column]),
+                 float(maximum[row, column]), float(total[row, column]), float(total[row, column]/counts[row, column]))
+                for row, start in enumerate(starts) for column, name in enumerate(names) if counts[row, column]]
 
-def extract(s7frame:bytearray, offset:float, type:str):
-    '''Extract value from s7frame
+
+class ParquetSink(Sink):
+    '''ParquetSink class\n
+    Stores the samples in columnar Parquet files, a timestamp, seq and read_ns column
+    plus one column per tag. Files roll every hour into Hive partitions
+    path/plc=<broker>/date=<YYYY-MM-DD>/hour=<HH>/ in UTC, which pyarrow.dataset,
+    DuckDB and pandas prune when scanning. Samples are buffered and written one row
+    group at a time, a file is complete once rolled or the sink is closed. Needs pyarrow.
     
     Parameters
     ----------
-    s7frame : bytearray
-        S7 protocol frame.
-    offset : float
-        Offset is an indicator for a postion of a value to be extracted.
-    type : str
-        Type of the value.
+    path : str
+        Root directory of the dataset.
+    row_group_size : int
+        Samples per row group.
+    compression : str
+        Parquet compression codec, e.g. 'zstd', 'snappy', 'gzip' or 'none'.
     
-    Returns
-    -------
-    float
-        If the type was float
-    int
-        If the type was an int
-    np.uint8
-        If the type was bool
-    None
-        If the type was none of the above
+    Attributes
+    ----------
+    schema : pyarrow.Schema or None
+        Schema of the files, taken from the first row group.
+    files : list of str
+        Paths of the written files.
     '''
     
-    bytes_to_read = 0
-    bits_to_read = 0
-    bytes = None
-    bit = None
-    value = None
-
-    # Separate the number and its floating point
-    byte_start_index = int(offset)
-    bit_start_index = np.ceil((offset*10-byte_start_index*10)).astype('uint8')
-
-    # Change data amount to read according to the s7 data types    
-    bytes_to_read = s7_bytes_to_read[type]
-    bits_to_read = s7_bits_to_read[type]
+    def __init__(self, path:str, row_group_size:int=10000, compression:str='zstd', name:str='parquet', **options):
+        super().__init__(name, **options)
+        self.path = path
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.buffer = []
+        self.partition = None
+        self.writer = None
+        self.schema = None
+        self.files = []
     
-    # Get binary data and transform it to the actual value
-    if bytes_to_read>0:
-        bytes = get_bytes(s7frame, byte_start_index, byte_start_index + bytes_to_read)
-        value = frombuffer(bytes, type)
-    elif bits_to_read==1:
-        bit = get_bit(s7frame, byte_start_index, bit_start_index)
-        value = bit      
-    return value
+    def close(self):
+        self.roll(None)
+    
+    def handle(self, snapshot:'Snapshot'):
+        # Hour of the sample since the epoch, the partition of its file
+        partition = (time.time_ns() if snapshot.timestamp_ns is None else snapshot.timestamp_ns)//3_600_000_000_000
+        if partition != self.partition:
+            self.roll(partition)
+        self.buffer.append(snapshot)
+        if len(self.buffer) >= self.row_group_size:
+            self.write_row_group()
+    
+    def roll(self, partition:int):
+        '''
+        Write the buffered samples and close the file of the current hour
+        '''
+        self.write_row_group()
+        if not self.writer is None:
+            self.writer.close()
+            self.writer = None
+        self.partition = partition
+    
+    def open_file(self, first_timestamp_ns:int):
+        import pyarrow.parquet as pq
+        hour = np.datetime64(self.partition, 'h')
+        directory = os.path.join(self.path, f'plc={self.source}', f'date={str(hour)[:10]}', f'hour={str(hour)[11:13]}')
+        os.makedirs(directory, exist_ok=True)
+        # Named after the first sample, a restart within the hour adds a file
+        file_path = os.path.join(directory, f'{self.source}-{first_timestamp_ns}.parquet')
+        self.writer = pq.ParquetWriter(file_path, self.schema, compression=self.compression)
+        self.files.append(file_path)
+    
+    def write_row_group(self):
+        if not self.buffer:
+            return
+        table = self.to_table(self.buffer)
+        self.buffer = []
+        if self.writer is None:
+            self.open_file(table.column('timestamp')[0].value)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+    
+    def to_table(self, snapshots:list) -> 'pa.Table':
+        '''
+        Convert the samples to an Arrow table with one column per tag
+        '''
+        import pyarrow as pa
+        rows = np.array([snapshot.values for snapshot in snapshots], dtype=object).reshape(len(snapshots), -1)
+        timestamps = [time.time_ns() if snapshot.timestamp_ns is None else snapshot.timestamp_ns for snapshot in snapshots]
+        arrays = [
+            pa.array(np.array(timestamps, dtype=np.int64), type=pa.timestamp('ns', tz='UTC')),
+            pa.array(np.array([snapshot.seq for snapshot in snapshots], dtype=np.int64)),
+            pa.array([None if snapshot.stamp is None else snapshot.stamp.read_ns for snapshot in snapshots], type=pa.int64()),
+        ]
+        # The values are Python objects, the data types of the layout keep the columns narrow
+        dtypes = [None]*rows.shape[1] if self.types is None else [s7_type(data_type).dtype for data_type in self.types]
+        arrays += [pa.array(np.array(rows[:, slot].tolist(), dtype=dtype)) for slot, dtype in enumerate(dtypes)]
+        table = pa.Table.from_arrays(arrays, names=['timestamp', 'seq', 'read_ns'] + list(snapshots[0].names))
+        if self.schema is None:
+            self.schema = table.schema
+        return table.cast(self.schema)
 
 
 class Broker(Thread):
@@ -192,26 +3346,60 @@ class Broker(Thread):
     ----------
     config_file_path : str
         A path to the s7 plc data block configuration file in .xlsx format.
-    plc_client : snap7.client.Client
-        S7 protocol client.
+    connection_pool : ConnectionPool
+        Pool the PLC session is taken from, shared by all the brokers by default.
+    connection : S7Connection or None
+        Session shared with the other brokers reading the same PLC, held while running.
+    reconnect_policy : ReconnectPolicy
+        Backoff of the reconnect attempts.
+    link_up : bool
+        False while the PLC is unreachable, the last snapshot is kept meanwhile.
+    read_failures : int
+        Consecutive failed reads of a PLC which still answers, e.g. a missing or protected datablock.
+    metrics : Metrics
+        Registry of the stage latencies and counters, labelled with plc=name of the broker.
     broker_queue : queue.Queue
         Queue to send over messages.
     broker_stop_event : threading.Event
         Event to stop the broker.
-    additional_offset : int or None
-        Extra offset value.
+    layout_analysis : dict or None
+        Field extents and the byte span of the layout, see analyze_layout().
     offset_start : int or None
-        Offset start index.
+        Datablock offset of the first byte read.
     offset_stop : int or None
-        Offset stop index.
+        Datablock offset after the last byte read.
+    layout : dict or None
+        Datablock layout, see load_layout().
     df_values_created : bool or None
-        True if the df has been created.
+        True if the layout has been loaded, the df itself is built on first use.
     plc_ip : str or None
         Plc's ip.
     datablock_number : int or None
         DB's number.
     interval_s : int or None
         Update time interval in seconds.
+    decoder : FrameDecoder or None
+        Decoder compiled from the value dataframe.
+    frame_log : FrameLogWriter or None
+        Binary log of the raw s7frames, disabled if None.
+    read_planner : ReadPlanner or None
+        Requests reading the datablock, planned on connect.
+    scheduler : PollScheduler or None
+        Poll scheduler of the running broker.
+    history : SampleRing or None
+        History of the decoded samples, disabled if None.
+    snapshot : Snapshot or None
+        The latest decoded values, replaced on every sample.
+    change_filter : ChangeFilter or None
+        Change-of-value filter, every sample is published if None.
+    dirty_detection : bool
+        True if unchanged s7frames are neither decoded nor published.
+    last_frame : bytearray or None
+        The previous s7frame.
+    udts : dict
+        UDT name -> layout, used to expand the UDT instances of the datablock.
+    sinks : dict
+        Sink name -> Sink receiving every published message besides the broker queue.
     '''
 
     def __init__(self, config_file_path:str, *args, **kwargs):
@@ -221,16 +3409,38 @@ class Broker(Thread):
         '''
         super().__init__(*args, **kwargs)
         self.config_file_path = config_file_path
-        self.plc_client = snap7.client.Client()
+        self.connection_pool = s7_connection_pool
+        self.connection = None
+        self.reconnect_policy = ReconnectPolicy()
+        self.link_up = False
+        self.read_failures = 0
+        self.metrics = s7_metrics
         self.broker_queue = Queue(1)
         self.broker_stop_event = Event()
-        self.additional_offset = None
+        self.layout_analysis = None
         self.offset_start = None
         self.offset_stop = None
+        self.layout = None
+        self._df_datablock_plc = None
+        self._df_values = None
         self.df_values_created = None
         self.plc_ip = None
         self.datablock_number = None
         self.interval_s = None 
+        self.rack = 0
+        self.slot = 1
+        self.tcpport = 102
+        self.decoder = None
+        self.frame_log = None
+        self.read_planner = None
+        self.scheduler = None
+        self.history = None
+        self.snapshot = None
+        self.change_filter = None
+        self.udts = {}
+        self.dirty_detection = False
+        self.last_frame = None
+        self.sinks = {}
         
     def __str__(self):
         info = '''
@@ -243,56 +3453,140 @@ class Broker(Thread):
         
     def prepare_value_frame(self):
         '''
-        Read config file, create new value dataframe.
+        Load the cached layout of the config file.
+        The value dataframe is built from it on first use, so pandas is imported only if needed.
         '''
-        self.df_datablock_plc = pd.read_excel('ExchangeData.xlsx', usecols=['Name', 'Data type', 'Offset', 'Comment'])
-        self.df_datablock_plc['Value'] = None
-        self.df_values = self.df_datablock_plc[['Offset', 'Value', 'Data type', 'Name']].copy().set_index('Offset')
+        self.layout = expand_layout(load_layout(self.config_file_path), self.udts)
+        self._df_datablock_plc = None
+        self._df_values = None
         self.df_values_created = True
-        return 'Broker> Value dataframe successfully created'
+        return 'Broker> Datablock layout loaded'
+    
+    def register_udt(self, name:str, config_file_path:str):
+        '''
+        Register the layout of a UDT, exported like a datablock with offsets relative to the UDT start.
+        Call before auto_config.
+        '''
+        self.udts[name.strip('"')] = load_layout(config_file_path)
+        return f'Broker> UDT {name} registered'
+    
+    @property
+    def df_datablock_plc(self):
+        '''
+        Datablock dataframe of the config file, built from the layout on first use
+        '''
+        assert self.df_values_created == True
+        if self._df_datablock_plc is None:
+            import pandas as pd
+            self._df_datablock_plc = pd.DataFrame({
+                                                'Name'      : self.layout['names'],
+                                                'Data type' : self.layout['types'],
+                                                'Offset'    : self.layout['offsets'],
+                                                'Comment'   : self.layout['comments'],
+                                                })
+            self._df_datablock_plc['Value'] = None
+        return self._df_datablock_plc
+    
+    @property
+    def df_values(self):
+        '''
+        Value dataframe indexed by Offset, built from the layout on first use
+        '''
+        if self._df_values is None:
+            self._df_values = self.df_datablock_plc[['Offset', 'Value', 'Data type', 'Name']].copy().set_index('Offset')
+        return self._df_values
     
-    def compute_additional_offset(self):
+    def analyze_layout(self):
         '''
-        Depending on the type of the last value in datablock the max byte range is likely to change
-        adjusting additional offset prevents the problem
+        Compute the exact extent of every field from its type, overlapping fields are rejected
         '''
         assert self.df_values_created == True
-        last_offset = self.df_values.iloc[-1]
-        last_value_type = last_offset['Data type']
-        self.additional_offset = s7_additional_offset[last_value_type]
-        return 'Broker> Additional offset added'  
+        self.layout_analysis = analyze_layout(self.layout)
+        overlaps = self.layout_analysis['overlaps']
+        assert not overlaps, f'Overlapping fields: {", ".join(f"{a}/{b}" for a, b in overlaps)}'
+        return f'Broker> Layout analyzed, {self.layout_analysis["gap_bytes"]} gap bytes in the span'
 
     def define_full_byte_range(self):
         '''
-        Define byte range to read, read it all, offset is the index
+        Define byte range to read, the smallest span covering every field
         '''
-        assert not self.additional_offset is None
-        self.offset_start = int(self.df_values.index.min())
-        self.offset_stop = int(np.ceil(self.df_values.index.max())) + self.additional_offset
+        assert not self.layout_analysis is None
+        self.offset_start = self.layout_analysis['offset_start']
+        self.offset_stop = self.layout_analysis['offset_stop']
         return 'Broker> Full byte range set'
+    
+    def compile_decoder(self):
+        '''
+        Compile the frame decoder from the value dataframe, s7frames start at offset_start
+        '''
+        assert not self.offset_start is None
+        self.decoder = FrameDecoder(
+                                    self.layout['names'],
+                                    self.layout['types'],
+                                    self.layout['offsets'],
+                                    base=self.offset_start
+                                    )
+        self.snapshot = Snapshot(self.decoder.names, self.decoder.index, np.full(self.decoder.size, None, dtype=object))
+        return 'Broker> Frame decoder compiled'
+    
+    def plan_reads(self, pdu_size:int=240):
+        '''
+        Plan the requests reading all the tags of the datablock, see ReadPlanner
+        '''
+        assert self.df_values_created == True
+        assert not self.datablock_number is None
+        tags = []
+        for offset, data_type in zip(self.layout['offsets'], self.layout['types']):
+            byte_index, _ = split_offset(offset)
+            # Bool occupies a single byte
+            tags.append(ReadRange('DB', self.datablock_number, byte_index, s7_type(data_type).size))
+        self.read_planner = ReadPlanner(tags, pdu_size)
+        cost = self.read_planner.cost()
+        return f'Broker> Reads planned, {cost["requests"]} requests, {cost["wasted_bytes"]} wasted bytes'
         
     def auto_config(self):
         '''
         Perform auto configuration of essential class parameters
         Manually the functions bellow must be invoked (in the right order):
             - prepare_value_frame()
-            - compute_additional_offset()
+            - analyze_layout()
             - define_full_byte_range()
+            - compile_decoder()
         '''
         print(self.prepare_value_frame())
-        print(self.compute_additional_offset())
+        print(self.analyze_layout())
         print(self.define_full_byte_range())
+        print(self.compile_decoder())
     
-    def change_connection_options(self, plc_ip:str, datablock_number:int, interval_s:float):
+    def change_connection_options(self, plc_ip:str, datablock_number:int, interval_s:float, rack:int=0, slot:int=1, tcpport:int=102):
         self.plc_ip = plc_ip
         self.datablock_number = datablock_number
         self.interval_s = interval_s   
+        self.rack = rack
+        self.slot = slot
+        self.tcpport = tcpport
+    
+    @property
+    def plc_client(self):
+        '''
+        S7 protocol client of the shared session, None before connect_PLC()
+        '''
+        return None if self.connection is None else self.connection.client
+    
+    def release_connection(self):
+        '''
+        Give the session back to the pool
+        '''
+        if not self.connection is None:
+            self.connection_pool.release(self.connection)
+            self.connection = None
         
     def verify_config_params(self):
         assert self.df_values_created == True
         assert not self.offset_start is None
         assert not self.offset_stop is None
-        assert not self.additional_offset is None
+        assert not self.layout_analysis is None
+        assert not self.decoder is None
         
     def verify_communication_params(self):
         assert not self.plc_ip is None
@@ -305,30 +3599,209 @@ class Broker(Thread):
     
     def get_values(self):
         self.verify_config_params()
-        return self.df_values[['Value','Name']].copy().set_index('Name')
+        return self.snapshot.to_frame()
+    
+    def get_snapshot(self) -> Snapshot:
+        self.verify_config_params()
+        return self.snapshot
+    
+    def get_metrics(self) -> dict:
+        '''
+        Metrics of this broker, see Metrics.collect()
+        '''
+        return self.metrics.collect(plc=self.name)
         
     def log(self, plc_data:bytearray, path:str='plc_data.txt'):
         with open(path, 'a+') as f:
             f.writelines((' '.join(str(byte) for byte in list(plc_data))) + '\n')   
+            
+    def enable_frame_log(self, path:str='plc_data.s7log', fsync_every:int=0):
+        '''
+        Log every received s7frame to a binary frame log, see FrameLogWriter
+        '''
+        self.frame_log = FrameLogWriter(path, fsync_every=fsync_every)
+        
+    def enable_history(self, capacity:int=3600):
+        '''
+        Keep the last decoded samples in a ring buffer, see SampleRing
+        '''
+        self.verify_config_params()
+        self.history = SampleRing(self.decoder.names, self.decoder.types, capacity)
+        
+    def enable_change_of_value(self, abs_deadband=0.0, pct_deadband=0.0, heartbeat_s:float=60.0):
+        '''
+        Publish only the changed tags and a full snapshot every heartbeat, see ChangeFilter
+        '''
+        self.verify_config_params()
+        self.change_filter = ChangeFilter(self.decoder.names, self.decoder.types, abs_deadband, pct_deadband, heartbeat_s)
+        
+    def change_reconnect_options(self, **options):
+        '''
+        Replace the reconnect policy, options are the parameters of ReconnectPolicy
+        '''
+        self.reconnect_policy = ReconnectPolicy(**options)
+        
+    def add_sink(self, sink:Sink) -> Sink:
+        '''
+        Start a sink fed with every published message, return it
+        '''
+        assert sink.name not in self.sinks, f'Sink {sink.name} already added'
+        sink.source = self.name
+        sink.types = None if self.decoder is None else self.decoder.types
+        sink.metrics = self.metrics
+        self.sinks[sink.name] = sink
+        sink.start()
+        return sink
+    
+    def remove_sink(self, name:str) -> Sink:
+        '''
+        Stop feeding a sink, it handles its queued messages and ends
+        '''
+        sink = self.sinks.pop(name)
+        sink.stop()
+        return sink
+        
+    def enable_dirty_detection(self):
+        '''
+        Compare every s7frame with the previous one, skip decoding and publishing of unchanged
+        frames and decode only the tags whose bytes changed
+        '''
+        self.dirty_detection = True
         
     def stop(self):
         '''
         Stop the broker
         '''
         self.broker_stop_event.set()
+        
+    def read_frame(self) -> tuple:
+        '''
+        Read the datablock image according to the plan, log it if enabled.
+        Return the s7frame and its ReadStamp
+        '''
+        try:
+            images, stamp = self.connection.execute(self.read_planner)
+        except s7_errors:
+            self.metrics.inc('s7_read_errors_total', plc=self.name)
+            raise
+        self.metrics.observe('s7_read_seconds', stamp.read_ns/1e9, plc=self.name)
+        plc_data = images[('DB', self.datablock_number)]
+        if not self.frame_log is None:
+            self.frame_log.write(plc_data, self.datablock_number, stamp)
+        return plc_data, stamp
+    
+    def decode_frame(self, plc_data:bytearray, stamp:ReadStamp=None) -> Snapshot:
+        '''
+        Decode the s7frame into a new snapshot, return it to be published.
+        The stamp of the read travels with the snapshot, it defaults to now.
+        With dirty detection None is returned for an unchanged s7frame,
+        unless a change-of-value heartbeat is due.
+        '''
+        stamp = ReadStamp.now() if stamp is None else stamp
+        now = time.monotonic()
+        decode_start = time.perf_counter()
+        if self.dirty_detection and not self.last_frame is None:
+            values = self.decoder.decode_changed(plc_data, self.last_frame, self.snapshot.values)
+        else:
+            values = self.decoder.decode(plc_data)
+        self.metrics.observe('s7_decode_seconds', time.perf_counter() - decode_start, plc=self.name)
+        self.metrics.inc('s7_samples_total', plc=self.name)
+        self.last_frame = plc_data
+        if values is None:
+            values = self.snapshot.values
+            if not self.history is None:
+                self.history.append(values, stamp)
+            if self.change_filter is None or not self.change_filter.heartbeat_due(now):
+                return None
+        elif not self.history is None:
+            self.history.append(values, stamp)
+        seq = 0 if self.snapshot.seq is None else self.snapshot.seq + 1
+        changed = None if self.change_filter is None else self.change_filter.update(values, now)
+        # Consumers and sinks share the values by reference
+        values.flags.writeable = False
+        self.snapshot = Snapshot(self.decoder.names, self.decoder.index, values, seq, stamp.timestamp_ns, changed, stamp)
+        return self.snapshot
+    
+    def publish_snapshot(self, snapshot:Snapshot):
+        '''
+        Publish the snapshot unless it is None or a change-of-value sample without any change
+        '''
+        if not snapshot is None and snapshot.has_changes():
+            self.publish(snapshot)
+    
+    def publish(self, message):
+        '''
+        Put the message into the broker queue, the oldest message is dropped if the queue is full
+        '''
+        put_start = time.perf_counter()
+        try:
+            self.broker_queue.put_nowait(message)
+        except Full:
+            try:
+                dropped = self.broker_queue.get_nowait()
+            except Empty:
+                # The consumer took the oldest message meanwhile, nothing is dropped
+                dropped = None
+            if type(dropped) is Snapshot and type(message) is Snapshot:
+                message = message.absorb(dropped)
+            self.broker_queue.put_nowait(message)
+            if not dropped is None:
+                self.metrics.inc('s7_dropped_samples_total', plc=self.name)
+        self.metrics.observe('s7_queue_put_seconds', time.perf_counter() - put_start, plc=self.name)
+        self.publish_to_sinks(message)
+        
+    def join_sinks(self):
+        '''
+        Wait for the sinks to handle their queued messages, bounded by sink_join_timeout_s per sink
+        '''
+        for sink in list(self.sinks.values()):
+            sink.join()
+            
+    def publish_to_sinks(self, message):
+        '''
+        Hand the message over to every sink by reference
+        '''
+        for sink in list(self.sinks.values()):
+            sink.offer(message)
+        
+    def receive(self, timeout:float=None):
+        '''
+        Take the next message from the broker queue on the consumer side, the age of samples is recorded
+        '''
+        message = self.broker_queue.get(timeout=timeout)
+        observe_dequeue_age(self.metrics, message, plc=self.name)
+        return message
+    
+    def open_session(self) -> int:
+        '''
+        Open the shared session and record the connect time, return the negotiated PDU size
+        '''
+        connect_start = time.perf_counter()
+        try:
+            pdu_size = self.connection.connect()
+        except s7_errors:
+            self.metrics.inc('s7_connect_failures_total', plc=self.name)
+            raise
+        self.metrics.observe('s7_connect_seconds', time.perf_counter() - connect_start, plc=self.name)
+        return pdu_size
     
     def connect_PLC(self):
         '''
-        Perform initial connection
+        Perform initial connection.
+        Return False if the broker can not run, an unreachable PLC is retried by reconnect_PLC()
         '''
         status_connected = False  
         try:
             socket.inet_aton(self.plc_ip)
             self.verify_configuration()
-            self.plc_client.connect(self.plc_ip, rack=0, slot=1, tcpport=102)
-        except RuntimeError: 
-            self.broker_queue.put_nowait('kill consumer')
-            print('Broker> Could not perform initial connection, exitting ...')
+            if self.connection is None:
+                self.connection = self.connection_pool.acquire(self.plc_ip, self.rack, self.slot, self.tcpport)
+            self.plan_reads(self.open_session())
+        except s7_errors: 
+            print('Broker> Could not perform initial connection, retrying ...')
+            self.link_up = False
+            self.reconnect_policy.record_failure()
+            status_connected = True
         except OSError:
             self.broker_queue.put_nowait('kill consumer')
             print('Broker> Wrong ip address, exitting ...')
@@ -338,69 +3811,91 @@ class Broker(Thread):
             
         else:
             print('Broker> Connected')
+            self.link_up = True
+            self.reconnect_policy.record_success()
             status_connected = True  
         return status_connected
     
+    def lose_link(self):
+        '''
+        Check the session after a failed read, schedule the reconnect if the PLC does not answer
+        '''
+        # The session is closed only if the PLC does not answer, other brokers may share it
+        self.link_up = self.connection.health_check(force=True)
+        if not self.link_up:
+            print('Broker> Connection lost, serving the last snapshot')
+            self.reconnect_policy.schedule()
+        else:
+            # The PLC answers but refuses the read, retry with backoff until the attempts are exhausted
+            self.read_failures += 1
+            self.link_up = False
+            self.reconnect_policy.record_failure()
+            print(f'Broker> Read refused {self.read_failures} times, retrying ... ({self.reconnect_policy.state})')
+            if self.reconnect_policy.exhausted():
+                print('Broker> Read attempts exhausted, exitting ...')
+            
+    def read_succeeded(self):
+        '''
+        Reset the failure count once a read works again
+        '''
+        if self.read_failures:
+            self.read_failures = 0
+            self.reconnect_policy.record_success()
+    
     def reconnect_PLC(self):
         '''
-        Function performs max 3 attempts
+        Perform a single reconnect attempt, the caller waits reconnect_policy.remaining_s() before.
         Return True if reconnected
         '''
-        attempt_count = 1 
-        while attempt_count <= 3 and not self.plc_client.get_connected():
-            print(f'Broker> Reconnecting ... attempt:{attempt_count}')
-            try:
-                time.sleep(2)
-                self.plc_client.connect(self.plc_ip, rack=0, slot=1, tcpport=102)
-            except RuntimeError:
-                attempt_count += 1
-        else: return self.plc_client.get_connected()
+        print(f'Broker> Reconnecting ... attempt:{self.reconnect_policy.attempts + 1} ({self.reconnect_policy.state})')
+        try:
+            self.plan_reads(self.open_session())
+        except s7_errors:
+            self.reconnect_policy.record_failure()
+            if self.reconnect_policy.exhausted():
+                print('Broker> Reconnect attempts exhausted, exitting ...')
+        else:
+            print('Broker> Reconnected')
+            self.link_up = True
+            if self.read_failures:
+                # Only a successful read resets the attempts of a refused read
+                self.reconnect_policy.next_attempt_at = None
+            else:
+                self.reconnect_policy.record_success()
+        return self.link_up
          
             
     def run(self):
         '''
-            Read plc data until the connection is interrupted,
-            dataframe with values filled sent to queue is the result
+            Read plc data until stopped or the reconnect attempts are exhausted,
+            snapshot of the values sent to queue is the result
         '''
         broker_condition_stop = not self.connect_PLC() 
+        self.scheduler = PollScheduler(self.interval_s)
 
-        while not broker_condition_stop and not self.broker_stop_event.is_set():
+        while not broker_condition_stop and not self.scheduler.wait(self.broker_stop_event):
+            if not self.link_up:
+                # Consumers keep the last snapshot, the broker waits for the next attempt or the stop
+                if not self.broker_stop_event.wait(self.reconnect_policy.remaining_s()):
+                    self.reconnect_PLC()
+                    broker_condition_stop = self.reconnect_policy.exhausted()
+                continue
             try:
-                plc_data = self.plc_client.read_area(
-                                                    area=snap7.types.Areas.DB,
-                                                    dbnumber=self.datablock_number,
-                                                    start=self.offset_start,
-                                                    size=self.offset_stop
-                                                    )
-                # Uncomment bellow to log the data
-                # self.log(plc_data, 'logs/plc_data.txt')             
-            except RuntimeError:
+                plc_data, stamp = self.read_frame()
+            except s7_errors:
                 print('Broker> Cant receive data!')
-                self.plc_client.disconnect()
-                # Try to reconnect
-                broker_condition_stop = not self.reconnect_PLC()
+                self.lose_link()
+                broker_condition_stop = self.reconnect_policy.exhausted()
                 
             else:
-                for offset in self.df_values.index:
-                    data_type = self.df_values['Data type'].loc[offset]
-                    value = extract(plc_data, offset, data_type)
-                    self.df_values['Value'].loc[offset] = value
-                result = self.df_values[['Value','Name']].copy().set_index('Name')
-                try:
-                    self.broker_queue.put_nowait(result)
-                except Full:
-                    self.broker_queue.get_nowait()
-                    self.broker_queue.put_nowait(result)
-                
-            finally:
-                time.sleep(self.interval_s)            
+                self.read_succeeded()
+                self.publish_snapshot(self.decode_frame(plc_data, stamp))
         else:
-            self.plc_client.disconnect()
-            try:
-                self.broker_queue.put_nowait('kill consumer')
-            except Full:
-                self.broker_queue.get_nowait()
-                self.broker_queue.put_nowait('kill consumer')
+            self.release_connection()
+            if not self.frame_log is None:
+                self.frame_log.close()
+            self.publish('kill consumer')
+            self.join_sinks()
             print('Broker thread is finshed!')
             
 
@@ -414,38 +3909,247 @@ class BrokerSim(Broker):
         A path to a file containing logged s7 frames.
     config_file_path : str
         A path to the s7 plc data block configuration file in .xlsx format.
+        
+    Attributes
+    ----------
+    start_index : int
+        Index of the first frame to replay.
+    stop_index : int or None
+        Index after the last frame to replay.
+    start_ns : int or None
+        Replay frames logged at or after this timestamp, binary logs only.
+    stop_ns : int or None
+        Replay frames logged before this timestamp, binary logs only.
+    wall_clock : bool
+        True if start_ns and stop_ns refer to the wall-clock.
+    speed : float or None
+        Replay speed factor, None or 0 replays unthrottled.
     '''
     def __init__(self, logs_path:str, config_file_path:str, *args, **kwargs):
         super().__init__(config_file_path, *args, **kwargs)
         self.logs_path = logs_path
+        self.start_index = 0
+        self.stop_index = None
+        self.start_ns = None
+        self.stop_ns = None
+        self.wall_clock = False
+        self.speed = 1.0
+        
+    def change_replay_options(self, start_index:int=0, stop_index:int=None, start_ns:int=None,
+                              stop_ns:int=None, wall_clock:bool=False, speed:float=1.0):
+        '''
+        Choose the replayed frames by index and/or time window and the replay speed.
+        Text logs carry no timestamps, they are replayed every 1/speed seconds.
+        '''
+        self.start_index = start_index
+        self.stop_index = stop_index
+        self.start_ns = start_ns
+        self.stop_ns = stop_ns
+        self.wall_clock = wall_clock
+        self.speed = speed
+    
+    def decode_logs(self) -> dict:
+        '''Decode the whole log file offline.
+        
+        Returns
+        -------
+        dict
+            Tag name -> typed column with one value per logged frame.
+        '''
+        
+        self.verify_config_params()
+        if read_frame_log_header(self.logs_path) is None:
+            frames = load_frame_log(self.logs_path)
+        else:
+            frames = FrameLog(self.logs_path).frames
+        return self.decoder.decode_batch(frames)
+    
+    def iter_frames(self):
+        '''
+        Yield (timestamp_ns, s7frame, stamp) of the replayed frames.
+        Binary frame logs are memory-mapped, the frames are views without copying.
+        Version 2 logs replay the logged ReadStamps, the other logs yield None stamps.
+        Text logs yield None timestamps, they are parsed and validated up front by load_frame_log().
+        '''
+        if read_frame_log_header(self.logs_path) is None:
+            for frame in load_frame_log(self.logs_path)[self.start_index:self.stop_index]:
+                yield None, frame, None
+        else:
+            frame_log = FrameLog(self.logs_path)
+            records = frame_log.window(self.start_ns, self.stop_ns, self.wall_clock)
+            for record in records[self.start_index:self.stop_index]:
+                stamp = frame_log.stamp(record)
+                if stamp is None:
+                    yield int(record['timestamp_ns']), record['frame'], None
+                else:
+                    yield stamp.request_monotonic_ns, record['frame'], stamp
+                
+    def wait_replay(self, timestamp_ns:int, replay_start:float, first_timestamp_ns:int) -> bool:
+        '''
+        Wait until the frame is due, return True if the broker was stopped meanwhile
+        '''
+        if not self.speed:
+            return self.broker_stop_event.is_set()
+        if timestamp_ns is None:
+            delay = 1/self.speed
+        else:
+            delay = replay_start + (timestamp_ns - first_timestamp_ns)/1e9/self.speed - time.monotonic()
+        return self.broker_stop_event.wait(max(delay, 0))
             
     def run(self):   
         try:
             self.verify_config_params()
-            with open(self.logs_path, 'r') as log_file:
-                for line in log_file:
-                    if self.broker_stop_event.is_set() : break
-                    # Convert a single line into the actual s7frame
-                    plc_data = bytearray(map(int, line[:-1].split(' ')))
-                    for offset in self.df_values.index:
-                        data_type = self.df_values['Data type'].loc[offset]
-                        value = extract(plc_data, offset, data_type)
-                        self.df_values['Value'].loc[offset] = value
-                    result = self.df_values[['Value','Name']].copy().set_index('Name')
-                    try: self.broker_queue.put_nowait(result)
-                    except Full:
-                        self.broker_queue.get_nowait()
-                        self.broker_queue.put_nowait(result)
-                    time.sleep(1)
-            try: self.broker_queue.put_nowait('kill consumer')
-            except Full:
-                    self.broker_queue.get_nowait()
-                    self.broker_queue.put_nowait(result)
+            replay_start = time.monotonic()
+            first_timestamp_ns = None
+            for frame_index, (timestamp_ns, plc_data, stamp) in enumerate(self.iter_frames()):
+                if frame_index == 0:
+                    first_timestamp_ns = timestamp_ns
+                elif self.wait_replay(timestamp_ns, replay_start, first_timestamp_ns): break
+                if self.broker_stop_event.is_set() : break
+                self.publish_snapshot(self.decode_frame(plc_data, stamp))
+            self.publish('kill consumer')
             print('BrokerSim> Simulation is finished') 
             
         except FileNotFoundError:
             print(f'BrokerSim> Could not find the file on path: {self.logs_path}')             
+        except ValueError as error:
+            print(f'BrokerSim> Invalid frame log: {error}')
         except AssertionError:
             print(f'BrokerSim> Wrong configuration')
+        finally:
+            # The sinks end after their queued samples, also when the replay failed
+            self.publish_to_sinks('kill consumer')
+            self.join_sinks()
+
+
+class AsyncBroker:
+    '''AsyncBroker class\n
+    Polls many PLCs concurrently from a single asyncio event loop.
+    Every PLC is a configured Broker which is never started as a thread,
+    its blocking snap7 calls run in a bounded executor shared by all the PLCs.
+    Results are pushed to asyncio queues as (name, result) tuples,
+    (name, 'kill consumer') is sent once polling of a PLC is finished.
+    
+    Parameters
+    ----------
+    max_workers : int
+        Size of the executor running the blocking snap7 calls.
+        
+    Attributes
+    ----------
+    brokers : dict
+        PLC name -> configured Broker.
+    executor : concurrent.futures.ThreadPoolExecutor
+        Executor running the blocking snap7 calls.
+    consumer_queues : list of asyncio.Queue
+        Queues of the subscribed consumers.
+    loop : asyncio.AbstractEventLoop or None
+        Event loop of the running broker.
+    stop_event : asyncio.Event or None
+        Event to stop the broker.
+    '''
+    
+    def __init__(self, max_workers:int=8):
+        self.brokers = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='AsyncBroker')
+        self.consumer_queues = []
+        self.loop = None
+        self.stop_event = None
+        
+    def add_plc(self, name:str, config_file_path:str, plc_ip:str, datablock_number:int, interval_s:float) -> Broker:
+        '''
+        Configure a PLC to be polled, return its broker
+        '''
+        broker = Broker(config_file_path, name=name)
+        broker.auto_config()
+        broker.change_connection_options(plc_ip, datablock_number, interval_s)
+        self.brokers[name] = broker
+        return broker
+    
+    def subscribe(self, maxsize:int=0) -> asyncio.Queue:
+        '''
+        Create a queue receiving results of all the PLCs
+        '''
+        consumer_queue = asyncio.Queue(maxsize)
+        self.consumer_queues.append(consumer_queue)
+        return consumer_queue
+    
+    def publish(self, message:tuple):
+        '''
+        Put the message into every consumer queue, the oldest message is dropped if a queue is full
+        '''
+        for consumer_queue in self.consumer_queues:
+            if consumer_queue.full():
+                name, dropped = consumer_queue.get_nowait()
+                if name == message[0] and type(dropped) is Snapshot and type(message[1]) is Snapshot:
+                    message = (name, message[1].absorb(dropped))
+                self.brokers[name].metrics.inc('s7_dropped_samples_total', plc=name)
+            consumer_queue.put_nowait(message)
             
+    def stop(self):
+        '''
+        Stop the broker, safe to call from any thread
+        '''
+        if not self.loop is None:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
             
+    async def wait_stop(self, timeout_s:float) -> bool:
+        '''
+        Sleep until the timeout or the stop, return True if stopped
+        '''
+        if timeout_s > 0:
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout_s)
+            except asyncio.TimeoutError:
+                pass
+        return self.stop_event.is_set()
+    
+    async def wait_slot(self, scheduler:PollScheduler) -> bool:
+        '''
+        Sleep until the next slot of the scheduler, return True if stopped
+        '''
+        stopped = await self.wait_stop(scheduler.next_delay())
+        if not stopped:
+            scheduler.mark_wakeup()
+        return stopped
+    
+    async def poll_PLC(self, name:str, broker:Broker):
+        '''
+        Read, decode and publish the data of a single PLC until stopped or disconnected
+        '''
+        broker_condition_stop = not await self.loop.run_in_executor(self.executor, broker.connect_PLC)
+        broker.scheduler = PollScheduler(broker.interval_s)
+        while not broker_condition_stop and not await self.wait_slot(broker.scheduler):
+            if not broker.link_up:
+                if not await self.wait_stop(broker.reconnect_policy.remaining_s()):
+                    await self.loop.run_in_executor(self.executor, broker.reconnect_PLC)
+                    broker_condition_stop = broker.reconnect_policy.exhausted()
+                continue
+            try:
+                plc_data, stamp = await self.loop.run_in_executor(self.executor, broker.read_frame)
+            except s7_errors:
+                print(f'AsyncBroker> {name}: Cant receive data!')
+                await self.loop.run_in_executor(self.executor, broker.lose_link)
+                broker_condition_stop = broker.reconnect_policy.exhausted()
+            else:
+                broker.read_succeeded()
+                snapshot = broker.decode_frame(plc_data, stamp)
+                if not snapshot is None and snapshot.has_changes():
+                    self.publish((name, snapshot))
+                    # A sink with the block policy may wait, never on the event loop
+                    await self.loop.run_in_executor(self.executor, broker.publish_to_sinks, snapshot)
+        await self.loop.run_in_executor(self.executor, broker.release_connection)
+        if not broker.frame_log is None:
+            broker.frame_log.close()
+        self.publish((name, 'kill consumer'))
+        await self.loop.run_in_executor(self.executor, broker.publish_to_sinks, 'kill consumer')
+        await self.loop.run_in_executor(self.executor, broker.join_sinks)
+        
+    async def run(self):
+        '''
+        Poll all the configured PLCs until stopped
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        await asyncio.gather(*(self.poll_PLC(name, broker) for name, broker in self.brokers.items()))
+        print('AsyncBroker> All PLCs finished')
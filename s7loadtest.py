@@ -0,0 +1,379 @@
+'''Load test of the real Broker path against a local snap7 server.
+
+The server hosts a datablock built from the .xlsx layout, fed with frames of a
+recorded frame log or synthetic waveforms, and injects latency, disconnects
+and read errors while N brokers poll it through connect_PLC, read_area and
+reconnect_PLC.
+
+Usage
+-----
+python s7loadtest.py Samples/s7_simulator/ExchangeData.xlsx --brokers 4 --interval 0.01 --duration 10
+    [--source sine|<frame log>] [--latency-ms 2] [--disconnect-at 3 --disconnect-for 2]
+    [--error-at 6 --error-for 1] [--separate-sessions] [--port 1102] [--output report.json]
+'''
+import argparse
+import ctypes
+import json
+import threading
+import time
+
+import numpy as np
+import snap7
+import snap7.server
+
+import s7comm
+import s7bench
+
+# python-snap7 2.0 names the server areas SrvArea
+srv_area_db = s7comm.snap7_types.SrvArea.DB if hasattr(s7comm.snap7_types, 'SrvArea') else s7comm.snap7_types.srvAreaDB
+
+def shared_buffer(datablock:bytearray):
+    '''
+    Buffer registered with the server sharing the memory of the datablock, python-snap7 2.0
+    serves a bytearray by reference but copies a ctypes array, the earlier C library needs one
+    '''
+    if hasattr(s7comm.snap7_types, 'SrvArea'):
+        return datablock
+    return (ctypes.c_uint8*len(datablock)).from_buffer(datablock)
+
+def load_frames(source:str, layout:dict, frame_count:int=1000) -> np.ndarray:
+    '''Get the frames fed to the server.
+
+    Parameters
+    ----------
+    source : str
+        'sine' for synthetic waveforms, or a path to a text or binary frame log.
+    layout : dict
+        Datablock layout, see s7comm.load_layout().
+    frame_count : int
+        Number of synthetic frames.
+
+    Returns
+    -------
+    np.ndarray
+        2-D uint8 array, one row per s7frame starting at the first byte of the layout.
+    '''
+
+    if source == 'sine':
+        return s7bench.synthetic_frames(layout, frame_count)
+    if s7comm.read_frame_log_header(source) is None:
+        return s7comm.load_frame_log(source)
+    return np.array(s7comm.FrameLog(source).frames)
+
+
+class LoadTestServer:
+    '''LoadTestServer class\n
+    snap7 server standing in for a PLC. A feeder thread copies the next frame
+    into the datablock at a fixed rate, faults are injected on demand.
+
+    Parameters
+    ----------
+    layout : dict
+        Datablock layout, see s7comm.load_layout().
+    frames : np.ndarray
+        Frames fed to the datablock, see load_frames().
+    datablock_number : int
+        Number of the hosted datablock.
+    port : int
+        TCP port of the server.
+    rate_hz : float
+        Frames copied into the datablock per second.
+
+    Attributes
+    ----------
+    analysis : dict
+        Extent of the layout, see s7comm.analyze_layout().
+    datablock : bytearray
+        Memory of the hosted datablock, shared with the server.
+    latency_s : float
+        Delay added to every read request.
+    server : snap7.server.Server or None
+        Running server.
+    frames_fed : int
+        Number of frames copied into the datablock.
+    '''
+
+    def __init__(self, layout:dict, frames:np.ndarray, datablock_number:int=1, port:int=1102, rate_hz:float=100.0):
+        self.analysis = s7comm.analyze_layout(layout)
+        self.frames = frames
+        self.datablock_number = datablock_number
+        self.port = port
+        self.rate_hz = rate_hz
+        self.datablock = bytearray(self.analysis['offset_stop'])
+        self.latency_s = 0.0
+        self.server = None
+        self.frames_fed = 0
+        self.feeder = None
+        self.feeder_stop_event = threading.Event()
+
+    def start(self):
+        '''
+        Start the server and the feeder
+        '''
+        self.open()
+        self.feeder_stop_event.clear()
+        self.feeder = threading.Thread(target=self.feed, name='LoadTestFeeder', daemon=True)
+        self.feeder.start()
+
+    def open(self):
+        self.server = snap7.server.Server(False)
+        self.server.register_area(srv_area_db, self.datablock_number, shared_buffer(self.datablock))
+        # The callback runs in the worker thread of the request, sleeping delays the response
+        self.server.set_read_events_callback(self.delay_read)
+        # Positional, python-snap7 2.0 renamed tcpport to tcp_port
+        self.server.start(self.port)
+
+    def close(self):
+        if not self.server is None:
+            self.server.stop()
+            self.server.destroy()
+            self.server = None
+
+    def stop(self):
+        self.feeder_stop_event.set()
+        if not self.feeder is None:
+            self.feeder.join()
+        self.close()
+
+    def delay_read(self, event):
+        if self.latency_s > 0:
+            time.sleep(self.latency_s)
+
+    def feed(self):
+        '''
+        Copy the frames into the datablock in a loop
+        '''
+        start, stop = self.analysis['offset_start'], self.analysis['offset_stop']
+        scheduler = s7comm.PollScheduler(1/self.rate_hz)
+        while not scheduler.wait(self.feeder_stop_event):
+            frame = self.frames[self.frames_fed % len(self.frames)]
+            data = frame.tobytes()[:stop - start]
+            self.datablock[start:start + len(data)] = data
+            self.frames_fed += 1
+
+    def disconnect(self, duration_s:float) -> tuple:
+        '''
+        Drop every session and refuse connections for a while, return monotonic ns of the outage and the restart
+        '''
+        outage_ns = time.monotonic_ns()
+        self.close()
+        time.sleep(duration_s)
+        self.open()
+        return outage_ns, time.monotonic_ns()
+
+    def inject_errors(self, duration_s:float) -> tuple:
+        '''
+        Answer the reads with errors while the sessions stay open, return monotonic ns of the start and the end
+        '''
+        start_ns = time.monotonic_ns()
+        self.server.unregister_area(srv_area_db, self.datablock_number)
+        time.sleep(duration_s)
+        self.server.register_area(srv_area_db, self.datablock_number, shared_buffer(self.datablock))
+        return start_ns, time.monotonic_ns()
+
+
+def consume(broker:s7comm.Broker, samples:list):
+    '''
+    Drain the broker queue, keep (request monotonic ns, read ns) of every snapshot
+    '''
+    while True:
+        try:
+            message = broker.receive(timeout=1.0)
+        except Exception:
+            if not broker.is_alive():
+                return
+            continue
+        if type(message) is s7comm.Snapshot:
+            samples.append((message.stamp.request_monotonic_ns, message.stamp.read_ns))
+        elif message == 'kill consumer':
+            return
+
+def first_sample_after(samples:list, timestamp_ns:int):
+    '''
+    Request time of the first sample read after the timestamp, None if there is none
+    '''
+    for request_ns, _ in samples:
+        if request_ns >= timestamp_ns:
+            return request_ns
+    return None
+
+def summarize(name:str, samples:list, duration_s:float, faults:dict) -> dict:
+    '''
+    Read rate, read latency percentiles and recovery times of a single broker
+    '''
+    read_ms = np.array([read_ns for _, read_ns in samples], dtype=np.float64)/1e6
+    summary = {
+        'broker'       : name,
+        'samples'      : len(samples),
+        'read_rate_hz' : len(samples)/duration_s,
+    }
+    if read_ms.size:
+        summary.update({
+            'read_p50_ms'  : float(np.percentile(read_ms, 50)),
+            'read_p99_ms'  : float(np.percentile(read_ms, 99)),
+            'read_p999_ms' : float(np.percentile(read_ms, 99.9)),
+            'read_max_ms'  : float(read_ms.max()),
+        })
+    for fault, (start_ns, stop_ns) in faults.items():
+        first_ns = first_sample_after(samples, stop_ns)
+        summary[f'{fault}_recovery_s'] = None if first_ns is None else (first_ns - stop_ns)/1e9
+        summary[f'{fault}_gap_s'] = None if first_ns is None else (first_ns - start_ns)/1e9
+    return summary
+
+def run_load_test(config_file_path:str, brokers:int=4, interval_s:float=0.01, duration_s:float=10.0,
+                  source:str='sine', port:int=1102, latency_ms:float=0.0, disconnect_at:float=None,
+                  disconnect_for:float=2.0, error_at:float=None, error_for:float=1.0,
+                  separate_sessions:bool=False, datablock_number:int=1) -> dict:
+    '''Drive N brokers against a LoadTestServer and report how they held up.
+
+    Parameters
+    ----------
+    config_file_path : str
+        A path to the s7 plc data block configuration file in .xlsx format.
+    brokers : int
+        Number of brokers polling the server.
+    interval_s : float
+        Poll period of every broker.
+    duration_s : float
+        Length of the test.
+    source : str
+        Frames fed to the server, see load_frames().
+    port : int
+        TCP port of the server.
+    latency_ms : float
+        Delay added to every read request.
+    disconnect_at : float or None
+        Seconds into the test when every session is dropped, None never.
+    disconnect_for : float
+        Length of the outage.
+    error_at : float or None
+        Seconds into the test when the reads start failing, None never.
+    error_for : float
+        Length of the failing period.
+    separate_sessions : bool
+        True gives every broker its own session, by default they share the pooled one.
+    datablock_number : int
+        Number of the hosted datablock.
+
+    Returns
+    -------
+    dict
+        settings, per-broker summaries, totals and the broker metrics.
+    '''
+
+    layout = s7comm.expand_layout(s7comm.load_layout(config_file_path))
+    server = LoadTestServer(layout, load_frames(source, layout), datablock_number, port, rate_hz=1/interval_s)
+    server.latency_s = latency_ms/1000
+    server.start()
+
+    polling = []
+    for index in range(brokers):
+        broker = s7comm.Broker(config_file_path, name=f'load{index}')
+        broker.auto_config()
+        broker.change_connection_options('127.0.0.1', datablock_number, interval_s, tcpport=port)
+        broker.change_reconnect_options(base_delay_s=0.2, max_delay_s=2.0, max_attempts=None, breaker_threshold=None)
+        if separate_sessions:
+            broker.connection_pool = s7comm.ConnectionPool()
+        samples = []
+        consumer = threading.Thread(target=consume, args=(broker, samples), daemon=True)
+        polling.append((broker, consumer, samples))
+
+    s7comm.s7_metrics.reset()
+    start = time.monotonic()
+    for broker, consumer, _ in polling:
+        broker.start()
+        consumer.start()
+
+    faults = {}
+    schedule = sorted(
+                      [(at, fault) for at, fault in ((disconnect_at, 'disconnect'), (error_at, 'error')) if not at is None]
+                      )
+    for at, fault in schedule:
+        time.sleep(max(0.0, start + at - time.monotonic()))
+        print(f'LoadTest> Injecting {fault}')
+        if fault == 'disconnect':
+            faults[fault] = server.disconnect(disconnect_for)
+        else:
+            faults[fault] = server.inject_errors(error_for)
+    time.sleep(max(0.0, start + duration_s - time.monotonic()))
+
+    for broker, _, _ in polling:
+        broker.stop()
+    for broker, consumer, _ in polling:
+        broker.join()
+        consumer.join()
+    elapsed_s = time.monotonic() - start
+    server.stop()
+
+    summaries = [summarize(broker.name, samples, elapsed_s, faults) for broker, _, samples in polling]
+    all_read_ms = np.array([read_ns for _, _, samples in polling for _, read_ns in samples], dtype=np.float64)/1e6
+    totals = {
+        'samples'      : int(sum(summary['samples'] for summary in summaries)),
+        'read_rate_hz' : sum(summary['read_rate_hz'] for summary in summaries),
+        'target_rate_hz' : brokers/interval_s,
+    }
+    if all_read_ms.size:
+        totals.update({
+            'read_p50_ms'  : float(np.percentile(all_read_ms, 50)),
+            'read_p99_ms'  : float(np.percentile(all_read_ms, 99)),
+            'read_p999_ms' : float(np.percentile(all_read_ms, 99.9)),
+            'read_max_ms'  : float(all_read_ms.max()),
+        })
+    for fault in faults:
+        recoveries = [summary[f'{fault}_recovery_s'] for summary in summaries]
+        totals[f'{fault}_recovery_max_s'] = None if None in recoveries else max(recoveries)
+    counters = s7comm.s7_metrics.collect()
+    for name in ('s7_read_errors_total', 's7_connect_failures_total', 's7_dropped_samples_total'):
+        totals[name] = sum(value for _, value in counters.get(name, []))
+    return {
+        'settings' : {
+            'brokers'           : brokers,
+            'interval_s'        : interval_s,
+            'duration_s'        : elapsed_s,
+            'source'            : source,
+            'latency_ms'        : latency_ms,
+            'separate_sessions' : separate_sessions,
+            'frames_fed'        : server.frames_fed,
+        },
+        'brokers'  : summaries,
+        'totals'   : totals,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of the Broker against a local snap7 server')
+    parser.add_argument('config_file_path')
+    parser.add_argument('--brokers', type=int, default=4)
+    parser.add_argument('--interval', type=float, default=0.01)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--source', default='sine', help="'sine' or a path to a text or binary frame log")
+    parser.add_argument('--port', type=int, default=1102)
+    parser.add_argument('--db', type=int, default=1)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--disconnect-at', type=float, default=None)
+    parser.add_argument('--disconnect-for', type=float, default=2.0)
+    parser.add_argument('--error-at', type=float, default=None)
+    parser.add_argument('--error-for', type=float, default=1.0)
+    parser.add_argument('--separate-sessions', action='store_true')
+    parser.add_argument('--output', default=None, help='JSON file receiving the report')
+    args = parser.parse_args()
+
+    report = run_load_test(
+                           args.config_file_path,
+                           brokers=args.brokers,
+                           interval_s=args.interval,
+                           duration_s=args.duration,
+                           source=args.source,
+                           port=args.port,
+                           latency_ms=args.latency_ms,
+                           disconnect_at=args.disconnect_at,
+                           disconnect_for=args.disconnect_for,
+                           error_at=args.error_at,
+                           error_for=args.error_for,
+                           separate_sessions=args.separate_sessions,
+                           datablock_number=args.db
+                           )
+    print(json.dumps(report['totals'], indent=2))
+    if not args.output is None:
+        with open(args.output, 'w') as report_file:
+            json.dump(report, report_file, indent=2)